@@ -1,17 +1,92 @@
+from functools import lru_cache
+from typing import Any, Iterable, Optional
 import os
 import sys
 import json
+import threading
 
 
 CUR_DIR = os.path.dirname(__file__)
 ROOT = os.path.abspath(os.path.join(CUR_DIR, "../../"))
 
+# Environment variables overriding config and credential values are named
+# after the upper cased key, e.g. SS_CRAWLER_CACHE_LOCATION
+ENV_PREFIX = "SS_CRAWLER_"
 
+
+@lru_cache(maxsize=None)
 def qualify_path(path):
     return os.path.abspath(path.format(ROOT=ROOT, PLATFORM=sys.platform))
 
 
-DEFAULT_CONF_PATH = qualify_path("{ROOT}/ss_crawler_config.json")
+DEFAULT_CONF_PATH = qualify_path(
+    os.environ.get(f"{ENV_PREFIX}CONFIG", "{ROOT}/ss_crawler_config.json")
+)
+
+
+# Keys of the config, optional ones included, that can be set through the
+# environment. Mappings such as "health" only come from the file.
+CONFIG_KEYS = (
+    "download_location",
+    "cache_location",
+    "chrome_driver",
+    "ingest_mode",
+    "use_index",
+    "crawl_mode",
+    "direct_transfer",
+    "user_data_dir",
+)
+
+_json_files = {}
+_json_lock = threading.Lock()
+_config_overrides = {}
+
+
+def load_json(path: str) -> dict:
+    # Parses the json file once and again only after its mtime (or size)
+    # changes. The returned dict is shared and must not be modified.
+    stat = os.stat(path)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    cached = _json_files.get(path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    with _json_lock:
+        with open(path) as _file:
+            data = json.load(_file)
+        _json_files[path] = (stamp, data)
+    return data
+
+
+def apply_overrides(
+    data: dict, overrides: dict, known_keys: Iterable[str] = ()
+) -> dict:
+    # known_keys may be set from the environment even when data lacks them
+    keys = set(data) | set(overrides) | set(known_keys)
+    env_values = {
+        key: value
+        for key in keys
+        if (value := os.environ.get(f"{ENV_PREFIX}{key.upper()}")) is not None
+    }
+    if not env_values and not overrides:
+        return data
+    data = dict(data)
+    data.update(env_values)
+    data.update(overrides)
+    return data
+
+
+def set_config_override(key: str, value: Any):
+    _config_overrides[key] = value
+
+
+def clear_config_overrides():
+    _config_overrides.clear()
+
+
+def as_bool(value: Any) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
 
 
 def abspath(path):
@@ -22,8 +97,7 @@ def abspath(path):
 
 
 def get_config(path=DEFAULT_CONF_PATH):
-    with open(path) as _conf:
-        return json.load(_conf)
+    return apply_overrides(load_json(path), _config_overrides, CONFIG_KEYS)
 
 
 def get_download_location(path=DEFAULT_CONF_PATH) -> str:
@@ -34,5 +108,33 @@ def get_cache_location(path=DEFAULT_CONF_PATH) -> str:
     return qualify_path(get_config(path)["cache_location"])
 
 
+def get_ingest_mode(path=DEFAULT_CONF_PATH) -> str:
+    return get_config(path).get("ingest_mode", "copy")
+
+
+def get_use_index(path=DEFAULT_CONF_PATH) -> bool:
+    return as_bool(get_config(path).get("use_index", False))
+
+
+def get_crawl_mode(path=DEFAULT_CONF_PATH) -> bool:
+    return as_bool(get_config(path).get("crawl_mode", False))
+
+
+def get_direct_transfer(path=DEFAULT_CONF_PATH) -> bool:
+    return as_bool(get_config(path).get("direct_transfer", False))
+
+
+def get_user_data_dir(path=DEFAULT_CONF_PATH) -> Optional[str]:
+    # base directory of the chrome profiles, one per driver profile name
+    user_data_dir = get_config(path).get("user_data_dir")
+    if not user_data_dir:
+        return None
+    return qualify_path(user_data_dir)
+
+
+def get_health_thresholds(path=DEFAULT_CONF_PATH) -> dict:
+    return dict(get_config(path).get("health", {}))
+
+
 def chrome_driver_location(path=DEFAULT_CONF_PATH) -> str:
     return qualify_path(get_config(path)["chrome_driver"])
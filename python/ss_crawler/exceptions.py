@@ -6,6 +6,10 @@ class UnknownValue(SSCrawlerException):
     pass
 
 
+class RouteNotLanded(UnknownValue):
+    pass
+
+
 class InvalidState(SSCrawlerException):
     pass
 
@@ -0,0 +1,140 @@
+from logging import getLogger
+from typing import Any, Callable, Optional
+import json
+import threading
+import time
+
+from selenium.common.exceptions import WebDriverException
+from selenium.webdriver.remote.webdriver import WebDriver
+
+from ss_crawler import javascript
+from ss_crawler.conf import DEFAULT_CONF_PATH, get_health_thresholds
+
+
+logger = getLogger(__name__)
+
+
+REFRESH = "refresh"
+RESTART = "restart"
+
+# Thresholds of a page sample beyond which the page is refreshed or the
+# browser restarted, overridden by the "health" mapping of the config
+DEFAULT_THRESHOLDS = {
+    "refresh_nodes": 30000,
+    "refresh_heap_mb": 512,
+    "refresh_latency": 1.0,
+    "restart_heap_mb": 1536,
+    "restart_latency": 5.0,
+}
+
+MB = 1024 * 1024
+
+# seconds a refreshed page is given to load before it is judged again
+SETTLE_TIME = 5.0
+SETTLE_INTERVAL = 1.0
+
+
+class HealthMonitor(object):
+    # Samples the page after each job and recycles the browser only when
+    # the sample crosses a threshold: the page is refreshed when the DOM,
+    # the JS heap or the WebDriver latency grow too much, and the browser
+    # is restarted when they are way off or a refresh did not help.
+    def __init__(
+        self,
+        conf=DEFAULT_CONF_PATH,
+        log_path: Optional[str] = None,
+        settle_time: float = SETTLE_TIME,
+        **thresholds: float,
+    ):
+        # log_path is a jsonl file the samples are appended to for tuning
+        self.thresholds = {
+            **DEFAULT_THRESHOLDS,
+            **get_health_thresholds(conf),
+            **thresholds,
+        }
+        self.log_path = log_path
+        self.settle_time = settle_time
+        self._lock = threading.Lock()
+
+    def sample(self, driver: WebDriver) -> dict[str, Any]:
+        # the latency is the round trip of the sampling script itself
+        start = time.perf_counter()
+        health = driver.execute_script(javascript.PAGE_HEALTH)
+        latency = time.perf_counter() - start
+        return {
+            "time": time.time(),
+            "nodes": health["nodes"],
+            "heap_used": health["heap_used"],
+            "heap_total": health["heap_total"],
+            "latency": latency,
+        }
+
+    def assess(self, sample: dict[str, Any]) -> Optional[str]:
+        thresholds = self.thresholds
+        heap_mb = (sample["heap_used"] or 0) / MB
+        if (
+            heap_mb > thresholds["restart_heap_mb"]
+            or sample["latency"] > thresholds["restart_latency"]
+        ):
+            return RESTART
+        if (
+            sample["nodes"] > thresholds["refresh_nodes"]
+            or heap_mb > thresholds["refresh_heap_mb"]
+            or sample["latency"] > thresholds["refresh_latency"]
+        ):
+            return REFRESH
+        return None
+
+    def log(self, sample: dict[str, Any], action: Optional[str]):
+        heap_mb = (sample["heap_used"] or 0) / MB
+        logger.info(
+            f"Page health: {sample['nodes']} nodes, {heap_mb:.0f}MB heap,"
+            f" {sample['latency'] * 1000:.0f}ms latency"
+            f" -> {action or 'ok'}"
+        )
+        if self.log_path is None:
+            return
+        with self._lock:
+            with open(self.log_path, "a") as log_file:
+                log_file.write(json.dumps({**sample, "action": action}) + "\n")
+
+    def _settles(self, driver: WebDriver) -> bool:
+        # the page is sampled until it comes under the thresholds, a page
+        # still loading right after a refresh would look unhealthy
+        deadline = time.monotonic() + self.settle_time
+        while True:
+            try:
+                if self.assess(self.sample(driver)) is None:
+                    return True
+            except WebDriverException:
+                pass
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(SETTLE_INTERVAL)
+
+    def maintain(
+        self,
+        driver: WebDriver,
+        refresh: Callable[[], Any],
+        restart: Callable[[], Any],
+    ) -> Optional[str]:
+        # Samples driver and refreshes or restarts it as needed, a refresh
+        # that leaves the page over the thresholds is followed by a restart.
+        # Returns the action taken.
+        try:
+            sample = self.sample(driver)
+        except WebDriverException as exc:
+            # left for the recovery of the next job that fails
+            logger.warning(f"Could not sample page health: {exc}")
+            return None
+        action = self.assess(sample)
+        self.log(sample, action)
+        if action == REFRESH:
+            refresh()
+            if self._settles(driver):
+                return action
+            action = RESTART
+        if action == RESTART:
+            logger.info("Restarting the browser")
+            restart()
+        return action
@@ -0,0 +1,171 @@
+# Scripts executed in the browser through ``execute_script``. They take
+# their css selectors as arguments so that ``locators`` stays the single
+# source of truth for the page structure.
+
+
+REVIEW_ITEMS_DATA = """
+var rows = arguments[0];
+var selectors = arguments[1];
+function cell(row, selector) {
+    var element = row.querySelector(selector);
+    return element ? element.innerText.trim() : null;
+}
+return rows.map(function (row) {
+    var name = row.querySelector(selectors.name);
+    return {
+        className: row.className,
+        order: cell(row, selectors.order),
+        name: name ? name.getAttribute("title") : null,
+        user: cell(row, selectors.user),
+        upload_time: cell(row, selectors.upload_time),
+        views: cell(row, selectors.views),
+        notes: cell(row, selectors.notes),
+        size: cell(row, selectors.size),
+        type: cell(row, selectors.type),
+    };
+});
+"""
+
+
+REVIEWS_DATA = """
+var rows = document.querySelectorAll(arguments[0]);
+var selectors = arguments[1];
+var start = arguments[2];
+function cell(row, selector) {
+    var element = row.querySelector(selector);
+    return element ? element.innerText.trim() : null;
+}
+return Array.prototype.slice.call(rows, start).map(function (row) {
+    return {
+        id: row.id,
+        name: cell(row, selectors.name),
+        item_count: cell(row, selectors.item_count),
+    };
+});
+"""
+
+
+# Async script: scrolls the scroller (to arguments[1], or to its bottom when
+# null) and resolves as soon as the infinite list reports a state:
+#   "loaded"  new list items were appended
+#   "end"     the list stopped changing for settle ms, with no loading
+#             indicator shown, without appending items. This is only a
+#             candidate end of the list for the caller to confirm.
+#   "timeout" the list kept loading or changing until timeout
+#   "idle"    the scroll position is too far from the bottom to load more
+#   "missing" the list container is not on the page
+WAIT_FOR_LIST_LOAD = """
+var scroller = arguments[0];
+var height = arguments[1];
+var container = document.querySelector(arguments[2]);
+var itemSelector = arguments[3];
+var loadingSelector = arguments[4];
+var timeout = arguments[5];
+var settle = arguments[6];
+var done = arguments[arguments.length - 1];
+if (!container) {
+    done({state: "missing", items: 0});
+    return;
+}
+function itemCount() {
+    return container.querySelectorAll(itemSelector).length;
+}
+function isLoading() {
+    var elements = document.querySelectorAll(loadingSelector);
+    for (var i = 0; i < elements.length; i++) {
+        if (elements[i].getClientRects().length) {
+            return true;
+        }
+    }
+    return false;
+}
+function nearBottom() {
+    var remaining = scroller.scrollHeight
+        - (scroller.scrollTop + scroller.clientHeight);
+    return remaining <= scroller.clientHeight;
+}
+var initial = itemCount();
+scroller.scrollTo(0, height === null ? scroller.scrollHeight : height);
+if (!nearBottom() && !isLoading()) {
+    done({state: "idle", items: initial});
+    return;
+}
+var finished = false;
+var observer = null;
+var timeoutTimer = null;
+var quietTimer = null;
+function finish(state) {
+    if (finished) {
+        return;
+    }
+    finished = true;
+    if (observer) {
+        observer.disconnect();
+    }
+    clearTimeout(timeoutTimer);
+    clearTimeout(quietTimer);
+    done({state: state, items: itemCount()});
+}
+function settled() {
+    if (isLoading()) {
+        waitQuiet();
+    } else if (itemCount() === initial) {
+        finish("end");
+    }
+}
+function waitQuiet() {
+    // the settle period restarts with every change of the list
+    clearTimeout(quietTimer);
+    quietTimer = setTimeout(settled, settle);
+}
+function check() {
+    if (itemCount() > initial) {
+        finish("loaded");
+    } else {
+        waitQuiet();
+    }
+}
+observer = new MutationObserver(check);
+observer.observe(scroller, {
+    childList: true,
+    subtree: true,
+    attributes: true,
+    attributeFilter: ["class", "style"],
+});
+timeoutTimer = setTimeout(function () { finish("timeout"); }, timeout);
+check();
+"""
+
+
+# Cheap health sample of the page: number of DOM nodes and, in Chrome, the
+# JS heap usage from the non standard performance.memory
+PAGE_HEALTH = """
+var memory = window.performance && window.performance.memory;
+return {
+    nodes: document.getElementsByTagName("*").length,
+    heap_used: memory ? memory.usedJSHeapSize : null,
+    heap_total: memory ? memory.totalJSHeapSize : null,
+};
+"""
+
+
+# Url a download item of the popover menu points to: the href of the item,
+# of its enclosing or nested link or a data-href / data-url attribute
+DOWNLOAD_ITEM_URL = """
+var item = arguments[0];
+var link = item.closest("a[href]") || item.querySelector("a[href]");
+if (link) {
+    return link.href;
+}
+var nodes = [item].concat(Array.from(item.querySelectorAll("*")));
+var attrs = ["href", "data-href", "data-url", "data-download-url"];
+for (var i = 0; i < nodes.length; i++) {
+    for (var j = 0; j < attrs.length; j++) {
+        var value = nodes[i].getAttribute(attrs[j]);
+        if (value) {
+            return new URL(value, document.baseURI).href;
+        }
+    }
+}
+return null;
+"""
@@ -25,6 +25,12 @@ class ProjectPageLocators(object):
         "div.headerTitle>div.headerTitle__content",
     )
     REVIEWS_CONTAINER = (By.CSS_SELECTOR, "section.items>div.reviews")
+    INFINITE_LIST = (By.CSS_SELECTOR, "div.infinite-list")
+    INFINITE_LIST_ITEM = (By.CSS_SELECTOR, "div.infinite-list-item")
+    INFINITE_LIST_LOADING = (
+        By.CSS_SELECTOR,
+        "div.infinite-list~div.loading, div.el-loading-mask",
+    )
     REVIEW = (
         By.CSS_SELECTOR,
         "div.infinite-list>div.review.infinite-list-item",
@@ -86,3 +92,16 @@ class DownloadDialogLocators(object):
     TITLE = (By.CSS_SELECTOR, "div.el-dialog__header>span.el-dialog__title")
     BODY = (By.CSS_SELECTOR, "div.el-dialog__body")
     DOWNLOAD_LINK = (By.CSS_SELECTOR, "div.el-dialog__body>div>div>a")
+
+
+def css_selector(locator: tuple[str, str]) -> str:
+    by, value = locator
+    if by == By.CSS_SELECTOR:
+        return value
+    if by == By.CLASS_NAME:
+        return f".{value}"
+    if by == By.ID:
+        return f"#{value}"
+    if by == By.TAG_NAME:
+        return value
+    raise ValueError(f"Cannot convert {by} locator to a css selector")
@@ -2,10 +2,12 @@ from fnmatch import fnmatch
 from logging import getLogger
 import os
 import re
-from typing import Optional, Any
+from typing import Iterator, Optional, Any, Union
 import datetime
 
+from selenium.webdriver.common.action_chains import ActionChains
 from selenium.webdriver.common.actions.action_builder import ActionBuilder
+from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.remote.webelement import WebElement
 from selenium.webdriver.remote.webdriver import WebDriver
 from selenium.common.exceptions import (
@@ -21,9 +23,12 @@ from selenium.webdriver.support.wait import WebDriverWait
 from ss_crawler.exceptions import (
     InvalidState,
     InvalidValue,
+    RouteNotLanded,
+    SSCrawlerException,
     UnknownValue,
     UnverifiedPage,
 )
+from ss_crawler import javascript
 from ss_crawler.utils.credentials import get_credentials
 
 
@@ -36,6 +41,7 @@ from ss_crawler.locators import (
     ProjectPageLocators,
     ReviewItemLocators,
     ReviewLocators,
+    css_selector,
 )
 
 
@@ -52,17 +58,26 @@ from ss_crawler.elements import (
 
 from ss_crawler.utils.download_management import DownloadManager
 from ss_crawler.utils.filesize import FileSize
+from ss_crawler.utils.transfer import HttpTransfer
+from ss_crawler.utils.webdriver import get_driver_download_location
 
 
 logger = getLogger(__name__)
 
 
+UPLOAD_TIME_FORMAT = "%m/%d/%y %I:%M %p"
+
+
 class Page(object):
     main_scroller = SimpleElement(PageLocators.BODY)
+    list_locators: Optional[dict[str, tuple[str, str]]] = None
+
+    # consecutive inconclusive list loads after which the list is given up
+    max_list_timeouts = 3
 
     def __init__(self, driver: WebDriver):
         self.driver = driver
-        self.full_load = False
+        self.reset_list()
         self._verify()
 
     def _verify(self):
@@ -77,7 +92,11 @@ class Page(object):
         url = get_credentials()["url"]
         logger.info(f"Refreshing page {url}")
         self.driver.get(url)
-        self.full_load = False
+        self.reset_list()
+
+    @property
+    def download_location(self) -> Optional[str]:
+        return get_driver_download_location(self.driver)
 
     @property
     def scroller_offset(self):
@@ -94,6 +113,12 @@ class Page(object):
     def verify(self) -> bool:
         return True
 
+    def reset_list(self):
+        # the list was reloaded or filtered, its end is to be found again
+        self.full_load = False
+        self._list_end_items: Optional[int] = None
+        self._list_timeouts = 0
+
     def wait_until_scroll_height_changed(self, scroll_height, wait: int = 10):
         def scrollHeightChanged(_):
             currentScrollHeight = int(
@@ -111,6 +136,66 @@ class Page(object):
         self.full_load = False
         return True
 
+    def scroll_and_wait_for_load(
+        self, height: Optional[int] = None, wait: int = 10, settle: float = 1
+    ) -> bool:
+        # Scrolls to height (the bottom when None) and returns whether the
+        # infinite list may hold more items. Loads are detected in the page
+        # by a MutationObserver; wait is only an upper bound. The end of the
+        # list is only reported once a second scroll to the bottom leaves
+        # the item count where the previous one settled.
+        if self.list_locators is None:
+            scroll_height = self.scroll_height
+            self.scroll_to(scroll_height if height is None else height)
+            return self.wait_until_scroll_height_changed(scroll_height, wait)
+        try:
+            result = self.driver.execute_async_script(
+                javascript.WAIT_FOR_LIST_LOAD,
+                self.main_scroller,
+                height,
+                css_selector(self.list_locators["list"]),
+                css_selector(self.list_locators["item"]),
+                css_selector(self.list_locators["loading"]),
+                int(wait * 1000),
+                int(settle * 1000),
+            )
+        except WebDriverException as exc:
+            logger.warning(f"List load detection failed, polling: {exc}")
+            scroll_height = self.scroll_height
+            self.scroll_to(scroll_height if height is None else height)
+            return self.wait_until_scroll_height_changed(scroll_height, wait)
+        state = result["state"]
+        items = result["items"]
+        logger.debug(f"List load state: {state} ({items} items)")
+        if state != "timeout":
+            self._list_timeouts = 0
+        if state == "loaded":
+            self.full_load = False
+            self._list_end_items = None
+            return True
+        if state == "end":
+            if self._list_end_items == items:
+                self.full_load = True
+                return False
+            # confirmed by the next scroll, unless it loads more items
+            self._list_end_items = items
+            return True
+        if state == "timeout":
+            self._list_timeouts += 1
+            if self._list_timeouts >= self.max_list_timeouts:
+                raise UnverifiedPage(
+                    f"{self.__class__.__name__} list did not finish loading"
+                    f" after {self._list_timeouts} scrolls"
+                )
+            logger.warning(f"List load inconclusive at {items} items")
+            self._list_end_items = None
+            return True
+        if state == "missing":
+            return self.wait_until_scroll_height_changed(
+                self.scroll_height, wait
+            )
+        return False
+
     def scroll_to(self, height: int):
         logger.debug(f"Scrolling to {height}")
         script = "arguments[0].scrollTo(0, arguments[1])"
@@ -138,14 +223,13 @@ class SubPage(Page):
         return True
 
     def scroll_to_top(self):
-        scroll_height = self.parent_page.scroll_height
         screen_y = self.get_rect()["y"]
         scroller_offset = self.parent_page.scroller_offset
-        self.parent_page.scroll_to(
-            int(self.parent_page.scroll_top + screen_y - scroller_offset)
-        )
-        if not self.parent_page.full_load:
-            self.parent_page.wait_until_scroll_height_changed(scroll_height)
+        height = int(self.parent_page.scroll_top + screen_y - scroller_offset)
+        if self.parent_page.full_load:
+            self.parent_page.scroll_to(height)
+        else:
+            self.parent_page.scroll_and_wait_for_load(height)
 
     def get_rect(self) -> dict[str, float]:
         location = self.driver.execute_script(
@@ -201,6 +285,12 @@ class ProjectPage(Page):
     )
     main_scroller = WaitedElement(ProjectPageLocators.MAIN_SCROLLER)
     reviews = WaitedElements(ProjectPageLocators.REVIEW)
+    search_field = WaitedElement(ProjectPageLocators.SEARCH_FIELD, wait=2)
+    list_locators = {
+        "list": ProjectPageLocators.INFINITE_LIST,
+        "item": ProjectPageLocators.INFINITE_LIST_ITEM,
+        "loading": ProjectPageLocators.INFINITE_LIST_LOADING,
+    }
 
     url_re = r"(.*)/pro/#/project/(\d+)/?(reviews/(\d+))?"
 
@@ -210,6 +300,20 @@ class ProjectPage(Page):
             return match.group(2)
         raise InvalidState("Cannot get id of project")
 
+    def get_route_review_id(self) -> Optional[str]:
+        if match := re.match(self.url_re, self.driver.current_url):
+            return match.group(4)
+        return None
+
+    def get_review_url(self, review_id: str) -> str:
+        url = self.driver.current_url
+        if match := re.match(self.url_re, url):
+            return (
+                f"{match.group(1)}/pro/#/project/{match.group(2)}"
+                f"/reviews/{review_id}"
+            )
+        raise InvalidState("Cannot build review url outside of a project")
+
     def get_project_title(self):
         return self.project_title.text.strip()
 
@@ -228,9 +332,7 @@ class ProjectPage(Page):
 
     def scroll_once(self, wait: int = 10) -> bool:
         logger.info(f"Attempting scroll to bottom ...")
-        scroll_height = int(self.main_scroller.get_attribute("scrollHeight"))
-        self.scroll_to(scroll_height)
-        return self.wait_until_scroll_height_changed(scroll_height, wait)
+        return self.scroll_and_wait_for_load(wait=wait)
 
     def scroll_to_end(self, max_scrolls: Optional[int] = None, wait: int = 5):
         logger.info(f"Scrolling {self.__class__.__name__} to end ...")
@@ -239,28 +341,146 @@ class ProjectPage(Page):
             if max_scrolls is not None:
                 counter += 1
                 if counter >= max_scrolls:
+                    self.scroll_once()
                     break
-        self.scroll_once()
 
     def get_reviews(self) -> list["Review"]:
         return [Review(self, element) for element in self.reviews]
 
+    def iter_review_data(
+        self, wait: int = 5
+    ) -> Iterator[list[dict[str, Any]]]:
+        # Yields the data of every batch of reviews the infinite list loads
+        # while it is scrolled to the end, instead of after the full scroll
+        project_data = self.get_data()
+        selectors = Review.data_selectors()
+        review_selector = css_selector(ProjectPageLocators.REVIEW)
+        seen = set()
+        end_reached = False
+        while True:
+            batch = []
+            raw_reviews = self.driver.execute_script(
+                javascript.REVIEWS_DATA, review_selector, selectors, len(seen)
+            )
+            for raw in raw_reviews:
+                review_data = Review.parse_data(raw, project_data)
+                if review_data["id"] in seen:
+                    continue
+                seen.add(review_data["id"])
+                batch.append(review_data)
+            if batch:
+                logger.info(f"Harvested {len(batch)} reviews")
+                yield batch
+            if end_reached:
+                break
+            end_reached = not self.scroll_once(wait)
+
     def _get_review(self, review_id: str):
         review_element = self.driver.find_element(
+            *self._review_locator(review_id)
+        )
+        return Review(self, review_element)
+
+    @staticmethod
+    def _review_locator(review_id: str) -> tuple[str, str]:
+        return (
             ProjectPageLocators.REVIEW_BY_ID[0],
             ProjectPageLocators.REVIEW_BY_ID[1].format(review_id=review_id),
         )
+
+    def open_review(self, review_id: str, wait: int = 10) -> "RoutedReview":
+        # Navigates straight to the reviews/<id> route of the review
+        if self.get_route_review_id() != review_id:
+            url = self.get_review_url(review_id)
+            logger.info(f"Opening {url}")
+            self.driver.get(url)
+            self.reset_list()
+        # a route that did not land shows as soon as the app drops it from
+        # the url or renders the list without the review, only a page that
+        # is still loading is waited for
+        def _landed(driver) -> Union[WebElement, str, bool]:
+            if self.get_route_review_id() != review_id:
+                return "route dropped"
+            elements = driver.find_elements(*self._review_locator(review_id))
+            if elements:
+                return elements[0]
+            if driver.find_elements(*ProjectPageLocators.REVIEW):
+                return "list shown without the review"
+            return False
+
+        try:
+            landed = WebDriverWait(self.driver, wait).until(_landed)
+        except TimeoutException:
+            # says nothing about the route, the page may just be slow
+            raise UnknownValue(
+                f"Cannot open route of review_{review_id}: timed out"
+            )
+        if isinstance(landed, str):
+            raise RouteNotLanded(
+                f"Cannot open route of review_{review_id}: {landed}"
+            )
+        return RoutedReview(self, landed)
+
+    def get_search_text(self) -> str:
+        return self.search_field.get_attribute("value") or ""
+
+    def clear_search(self):
+        field = self.search_field
+        text = field.get_attribute("value")
+        if text:
+            # backspaces instead of clear() so the SPA sees input events
+            field.send_keys(Keys.BACKSPACE * len(text))
+            self.reset_list()
+
+    def search(self, text: str):
+        logger.info(f"Searching reviews for '{text}'")
+        self.clear_search()
+        self.search_field.send_keys(text)
+        self.reset_list()
+
+    def search_review(self, review_id: str, text: str, wait: int = 5):
+        self.search(text)
+        try:
+            review_element = WebDriverWait(self.driver, wait).until(
+                presence_of_element_located(self._review_locator(review_id))
+            )
+        except TimeoutException:
+            raise UnknownValue(
+                f"Search for '{text}' did not find review_{review_id}"
+            )
         return Review(self, review_element)
 
-    def get_review(self, review_id: str) -> "Review":
+    def get_review(
+        self,
+        review_id: str,
+        name: Optional[str] = None,
+        search: bool = True,
+    ) -> "Review":
+        # Looks up the review in the loaded list, then through the search
+        # box (by name when known, otherwise by id) and falls back to
+        # scrolling the infinite list when the search misses
         logger.info(f"Getting review_{review_id}")
+        try:
+            return self._get_review(review_id)
+        except NoSuchElementException:
+            pass
+        if search:
+            for text in filter(None, (name, review_id)):
+                try:
+                    return self.search_review(review_id, text)
+                except (UnknownValue, WebDriverException) as exc:
+                    logger.info(f"Search lookup missed: {exc}")
+            try:
+                self.clear_search()
+            except WebDriverException:
+                pass
         while True:
             try:
                 return self._get_review(review_id)
             except NoSuchElementException:
                 if not self.scroll_once():
                     break
-        raise UnknownValue(f"Cannot find review for id: {id}")
+        raise UnknownValue(f"Cannot find review for id: {review_id}")
 
 
 class ProjectSubPage(SubPage):
@@ -280,12 +500,40 @@ class Review(ProjectSubPage):
     review_items = WaitedSubPageElements(ReviewLocators.REVIEW_ITEM)
     item_count = SimpleSubPageElement(ReviewLocators.ITEM_COUNT)
 
-    def get_id(self) -> str:
-        id_string = self.root_element.get_dom_attribute("id")
+    @staticmethod
+    def _id_from_dom_id(id_string: str) -> str:
         if match := re.match(r"^review_(\d+)$", id_string):
             return match.group(1)
         return id_string
 
+    @classmethod
+    def data_selectors(cls) -> dict[str, str]:
+        return {
+            "name": css_selector(ReviewLocators.REVIEW_NAME),
+            "item_count": css_selector(ReviewLocators.ITEM_COUNT),
+        }
+
+    @classmethod
+    def parse_data(
+        cls, raw: dict[str, Any], project_data: dict[str, Any]
+    ) -> dict[str, Any]:
+        # raw is a review extracted by javascript.REVIEWS_DATA
+        try:
+            item_count = int(raw["item_count"])
+        except (TypeError, ValueError) as exc:
+            raise InvalidValue(*exc.args) from exc
+        return {
+            "id": cls._id_from_dom_id(raw["id"]),
+            "project_id": project_data["id"],
+            "name": raw["name"],
+            "item_count": item_count,
+            "workspace": project_data["workspace"],
+            "project": project_data["project"],
+        }
+
+    def get_id(self) -> str:
+        return self._id_from_dom_id(self.root_element.get_dom_attribute("id"))
+
     def get_name(self) -> str:
         review_name = self.root_element.find_element(
             *(ReviewLocators.REVIEW_NAME)
@@ -386,6 +634,30 @@ class Review(ProjectSubPage):
             for element in self.review_items
         ]
 
+    def get_review_items_data(
+        self, bulk: bool = True
+    ) -> list[dict[str, Any]]:
+        if bulk:
+            try:
+                return self._get_review_items_data_bulk()
+            except (SSCrawlerException, WebDriverException) as exc:
+                logger.warning(
+                    f"Bulk extraction failed for review_{self.get_id()}, "
+                    f"falling back to per row extraction: {exc}"
+                )
+        return [item.get_data() for item in self.get_review_items()]
+
+    def _get_review_items_data_bulk(self) -> list[dict[str, Any]]:
+        self.show_details_table()
+        rows = self.review_items
+        if not rows:
+            return []
+        raw_rows = self.driver.execute_script(
+            javascript.REVIEW_ITEMS_DATA, rows, ReviewItem.cell_selectors()
+        )
+        project_id = self.get_project_id()
+        return [ReviewItem.parse_data(raw, project_id) for raw in raw_rows]
+
     def request_download(self, text, max_tries: int = 10):
         self.scroll_to_top()
         attempts = 0
@@ -403,7 +675,9 @@ class Review(ProjectSubPage):
         item.click()
 
     def download_csv(self, max_tries: int = 10):
-        with DownloadManager(pattern="*.csv") as dm:
+        with DownloadManager(
+            pattern="*.csv", download_location=self.download_location
+        ) as dm:
             self.request_download("*CSV", max_tries=max_tries)
         print(f"CSV File Downloaded: {dm.downloaded_file}")
         return dm.downloaded_file
@@ -420,12 +694,20 @@ class Review(ProjectSubPage):
                 attempts += 1
                 if attempts >= max_tries:
                     raise
-        with DownloadManager(pattern="*.zip") as dm:
+        with DownloadManager(
+            pattern="*.zip", download_location=self.download_location
+        ) as dm:
             diag.begin_download()
         print(f"Zip File Downloaded: {dm.downloaded_file}")
         return dm.downloaded_file
 
 
+class RoutedReview(Review):
+    # A review opened through its reviews/<id> route
+    def verify(self) -> bool:
+        return self.get_id() == self.parent_page.get_route_review_id()
+
+
 class ReviewItem(ProjectSubPage):
     order_cell = SimpleSubPageElement(ReviewItemLocators.ORDER_CELL)
     name_cell = SimpleSubPageElement(ReviewItemLocators.NAME_CELL)
@@ -437,17 +719,74 @@ class ReviewItem(ProjectSubPage):
     type_cell = SimpleSubPageElement(ReviewItemLocators.TYPE_CELL)
     download_button = WaitedSubPageElement(ReviewItemLocators.DL_BUTTON, 1)
 
-    def get_id(self) -> str:
-        for _class in self.root_element.get_attribute("className").split():
-            if match := re.match(r"^id_(\d+)$", _class):
+    @staticmethod
+    def _id_from_class_name(class_name: str, prefix: str) -> str:
+        for _class in class_name.split():
+            if match := re.match(rf"^{prefix}_(\d+)$", _class):
                 return match.group(1)
-        raise InvalidState("Cannot get_id for review_item")
+        raise InvalidState(f"Cannot get {prefix} for review_item")
+
+    @staticmethod
+    def _parse_int(text: Optional[str]) -> int:
+        try:
+            return int(text)  # type: ignore
+        except (TypeError, ValueError) as exc:
+            raise InvalidValue(*exc.args) from exc
+
+    @staticmethod
+    def parse_upload_time(text: str) -> datetime.datetime:
+        return datetime.datetime.strptime(text, UPLOAD_TIME_FORMAT)
+
+    @classmethod
+    def cell_selectors(cls) -> dict[str, str]:
+        return {
+            "order": css_selector(ReviewItemLocators.ORDER_CELL),
+            "name": css_selector(ReviewItemLocators.NAME_CELL),
+            "user": css_selector(ReviewItemLocators.BY_CELL),
+            "upload_time": css_selector(ReviewItemLocators.UPLOADED_CELL),
+            "views": css_selector(ReviewItemLocators.VIEWS_CELL),
+            "notes": css_selector(ReviewItemLocators.NOTES_CELL),
+            "size": css_selector(ReviewItemLocators.SIZE_CELL),
+            "type": css_selector(ReviewItemLocators.TYPE_CELL),
+        }
+
+    @classmethod
+    def parse_data(
+        cls, raw: dict[str, Any], project_id: str
+    ) -> dict[str, Any]:
+        # raw is a row extracted by javascript.REVIEW_ITEMS_DATA
+        for key in ("size", "upload_time"):
+            if raw.get(key) is None:
+                raise InvalidValue(f"Missing {key} cell for review_item")
+        try:
+            upload_time = cls.parse_upload_time(raw["upload_time"])
+        except ValueError as exc:
+            raise InvalidValue(*exc.args) from exc
+        return {
+            "id": cls._id_from_class_name(raw["className"], "id"),
+            "review_id": cls._id_from_class_name(
+                raw["className"], "review_id"
+            ),
+            "project_id": project_id,
+            "order": cls._parse_int(raw["order"]),
+            "name": raw["name"],
+            "views": cls._parse_int(raw["views"]),
+            "notes": cls._parse_int(raw["notes"]),
+            "size": FileSize(raw["size"]),
+            "type": raw["type"],
+            "user": raw["user"],
+            "upload_time": upload_time,
+        }
+
+    def get_id(self) -> str:
+        return self._id_from_class_name(
+            self.root_element.get_attribute("className"), "id"
+        )
 
     def get_review_id(self) -> str:
-        for _class in self.root_element.get_attribute("className").split():
-            if match := re.match(r"^review_id_(\d+)$", _class):
-                return match.group(1)
-        raise InvalidState("Cannot get_id for review_item")
+        return self._id_from_class_name(
+            self.root_element.get_attribute("className"), "review_id"
+        )
 
     def get_project_id(self) -> str:
         return self.parent_page.get_id()
@@ -456,10 +795,7 @@ class ReviewItem(ProjectSubPage):
         return self.parent_page.get_review(self.get_id())
 
     def get_order(self):
-        try:
-            return int(self.order_cell.text)
-        except ValueError as exc:
-            raise InvalidValue(*exc.args) from exc
+        return self._parse_int(self.order_cell.text)
 
     def get_name(self):
         return self.name_cell.get_dom_attribute("title")
@@ -480,8 +816,7 @@ class ReviewItem(ProjectSubPage):
         return self.by_cell.text
 
     def get_upload_time(self):
-        text = self.uploaded_cell.text
-        return datetime.datetime.strptime(text, "%m/%d/%y %I:%M %p")
+        return self.parse_upload_time(self.uploaded_cell.text)
 
     def get_data(self) -> dict[str, Any]:
         return {
@@ -498,7 +833,7 @@ class ReviewItem(ProjectSubPage):
             "upload_time": self.get_upload_time(),
         }
 
-    def initiate_download(self, text, max_tries=10):
+    def open_download_menu(self, max_tries=10) -> "PopOverMenu":
         attempts = 0
         while True:
             try:
@@ -509,25 +844,63 @@ class ReviewItem(ProjectSubPage):
                 attempts += 1
                 if attempts >= max_tries:
                     raise
-        popovermenu = PopOverMenu(self.parent_page)
+        return PopOverMenu(self.parent_page)
+
+    def initiate_download(self, text, max_tries=10):
+        popovermenu = self.open_download_menu(max_tries=max_tries)
         item = popovermenu.get_download_item_by_text(text)
         item.click()
 
-    def download_original(self, max_tries=2):
+    def get_download_url(self, text, max_tries=10) -> str:
+        popovermenu = self.open_download_menu(max_tries=max_tries)
+        try:
+            return popovermenu.get_download_url(text)
+        finally:
+            popovermenu.close()
+
+    def transfer_original(
+        self, transfer: HttpTransfer, dest: str, max_tries=2, detach=False
+    ):
+        # Fetches the original media straight into dest over http with the
+        # session of the browser, skipping the download directory. With
+        # detach the PendingTransfer is returned for a DownloadPipeline.
+        url = self.get_download_url("*Original*", max_tries=max_tries)
+        pending = transfer.prepare(
+            self.driver, url, dest, file_size=self.get_size()
+        )
+        if detach:
+            return pending
+        return pending.run()
+
+    def download_original(self, max_tries=2, detach=False):
+        # With detach the download is only started and the PendingDownload
+        # is returned for a DownloadPipeline to complete
         item_text = "*Original*"
-        _, ext = os.path.splitext(self.get_name())
+        name = self.get_name()
+        _, ext = os.path.splitext(name)
         with DownloadManager(
             pattern=f"*{ext}",
             file_size=self.get_size(),
+            download_location=self.download_location,
+            detach=detach,
+            file_name=name,
         ) as dm:
             self.initiate_download(item_text, max_tries=max_tries)
+        if detach:
+            return dm.pending
         return dm.downloaded_file
 
-    def download_transcoded(self, max_tries=2):
+    def download_transcoded(self, max_tries=2, detach=False):
         item_text = "*Transcoded*"
         _, ext = os.path.splitext(self.get_name().lower())
-        with DownloadManager(pattern=f"*{ext}") as dm:
+        with DownloadManager(
+            pattern=f"*{ext}",
+            download_location=self.download_location,
+            detach=detach,
+        ) as dm:
             self.initiate_download(item_text, max_tries=max_tries)
+        if detach:
+            return dm.pending
         print(f"{ext} Media Downloaded: {dm.downloaded_file}")
         return dm.downloaded_file
 
@@ -557,6 +930,16 @@ class PopOverMenu(SubPage):
             f"Cannot find download item with {match_text}"
         )
 
+    def get_download_url(self, match_text: str) -> str:
+        item = self.get_download_item_by_text(match_text)
+        url = self.driver.execute_script(javascript.DOWNLOAD_ITEM_URL, item)
+        if not url:
+            raise UnknownValue(f"No url for download item {match_text}")
+        return url
+
+    def close(self):
+        ActionChains(self.driver).send_keys(Keys.ESCAPE).perform()
+
 
 class DownloadDialog(SubPage):
     root_element = SubPageRootElement(DownloadDialogLocators.DIALOG)
@@ -0,0 +1,211 @@
+from logging import getLogger
+from typing import Any, Callable, Optional
+from weakref import WeakKeyDictionary
+import collections
+import random
+import threading
+import time
+
+from selenium.common.exceptions import (
+    InvalidSessionIdException,
+    NoSuchElementException,
+    NoSuchWindowException,
+    StaleElementReferenceException,
+    TimeoutException,
+    WebDriverException,
+)
+from selenium.webdriver.common.action_chains import ActionChains
+from selenium.webdriver.common.keys import Keys
+from selenium.webdriver.remote.webdriver import WebDriver
+
+from ss_crawler.exceptions import (
+    DownloadException,
+    SSCrawlerException,
+    UnverifiedPage,
+)
+from ss_crawler.scripts import (
+    ensure_project_page,
+    load_project_page,
+    restart_browser,
+)
+
+
+logger = getLogger(__name__)
+
+
+STALE_ELEMENT = "stale_element"
+POPOVER_NOT_FOUND = "popover_not_found"
+DOWNLOAD_NOT_DETECTED = "download_not_detected"
+PAGE_UNVERIFIED = "page_unverified"
+SESSION_DEAD = "session_dead"
+UNKNOWN = "unknown"
+
+# messages of WebDriverExceptions raised once the browser is gone
+SESSION_DEAD_MESSAGES = (
+    "invalid session id",
+    "session deleted",
+    "chrome not reachable",
+    "disconnected",
+    "no such window",
+    "target window already closed",
+)
+
+# remedies of each failure class from the cheapest, repeated failures of the
+# same job escalate to the next one
+REMEDIES = {
+    STALE_ELEMENT: ("retry", "refresh", "reload", "restart"),
+    POPOVER_NOT_FOUND: ("dismiss", "refresh", "reload", "restart"),
+    DOWNLOAD_NOT_DETECTED: ("retry", "dismiss", "refresh", "restart"),
+    PAGE_UNVERIFIED: ("refresh", "reload", "restart"),
+    SESSION_DEAD: ("restart",),
+    UNKNOWN: ("refresh", "reload", "restart"),
+}
+
+
+def is_session_dead(exc: BaseException) -> bool:
+    if isinstance(exc, (InvalidSessionIdException, NoSuchWindowException)):
+        return True
+    if isinstance(exc, WebDriverException):
+        message = (exc.msg or "").lower()
+        return any(dead in message for dead in SESSION_DEAD_MESSAGES)
+    return False
+
+
+def classify(exc: BaseException) -> str:
+    if is_session_dead(exc):
+        return SESSION_DEAD
+    if isinstance(exc, StaleElementReferenceException):
+        return STALE_ELEMENT
+    if isinstance(exc, DownloadException):
+        return DOWNLOAD_NOT_DETECTED
+    if isinstance(exc, UnverifiedPage):
+        if str(exc).startswith("PopOverMenu"):
+            return POPOVER_NOT_FOUND
+        return PAGE_UNVERIFIED
+    if isinstance(exc, NoSuchElementException) and "download item" in str(
+        exc
+    ):
+        return POPOVER_NOT_FOUND
+    if isinstance(exc, TimeoutException):
+        return PAGE_UNVERIFIED
+    return UNKNOWN
+
+
+class RecoveryPolicy(object):
+    # Recovers a driver after a failed job with the cheapest remedy for the
+    # class of the failure, waiting with exponential backoff (and optional
+    # jitter) before the job is tried again. The time spent recovering is
+    # kept per failure class.
+    def __init__(
+        self,
+        backoff: float = 1,
+        max_backoff: float = 30,
+        jitter: float = 0,
+        before_restart: Optional[Callable[[WebDriver], Any]] = None,
+    ):
+        # before_restart is called with the driver about to be restarted,
+        # e.g. to let the downloads of its browser complete
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.before_restart = before_restart
+        self.stats = collections.defaultdict(
+            lambda: {
+                "count": 0,
+                "time": 0.0,
+                "remedies": collections.Counter(),
+            }
+        )
+        self._handles: "WeakKeyDictionary[WebDriver, str]" = (
+            WeakKeyDictionary()
+        )
+        self._lock = threading.Lock()
+        self._remedies: dict[str, Callable[[WebDriver], None]] = {
+            "retry": self._retry,
+            "dismiss": self._dismiss,
+            "refresh": self._refresh,
+            "reload": self._reload,
+            "restart": self._restart,
+        }
+
+    def register(self, driver: WebDriver):
+        # the current window is the one to return to when recovering, e.g.
+        # after a download opened a new tab
+        self._handles[driver] = driver.current_window_handle
+
+    def get_delay(self, attempt: int) -> float:
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        if self.jitter:
+            delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        return max(0, delay)
+
+    def recover(
+        self, driver: WebDriver, exc: BaseException, attempt: int = 1
+    ) -> str:
+        # attempt is the number of times the job failed so far, returns the
+        # remedy that was applied
+        failure = classify(exc)
+        remedies = REMEDIES[failure]
+        start = time.perf_counter()
+        time.sleep(self.get_delay(attempt))
+        applied = None
+        for remedy in remedies[min(attempt, len(remedies)) - 1 :]:
+            try:
+                logger.info(f"Recovering from {failure} with {remedy}")
+                self._remedies[remedy](driver)
+                applied = remedy
+                break
+            except (SSCrawlerException, WebDriverException) as remedy_exc:
+                logger.warning(f"Remedy {remedy} failed: {remedy_exc}")
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            stats = self.stats[failure]
+            stats["count"] += 1
+            stats["time"] += elapsed
+            stats["remedies"][applied or "failed"] += 1
+        if applied is None:
+            raise exc
+        return applied
+
+    def _switch_to_handle(self, driver: WebDriver):
+        handle = self._handles.get(driver)
+        if handle is not None and driver.current_window_handle != handle:
+            driver.switch_to.window(handle)
+
+    def _retry(self, driver: WebDriver):
+        pass
+
+    def _dismiss(self, driver: WebDriver):
+        # closes popovers and dialogs left open by the failed job
+        self._switch_to_handle(driver)
+        ActionChains(driver).send_keys(Keys.ESCAPE).perform()
+
+    def _refresh(self, driver: WebDriver):
+        self._switch_to_handle(driver)
+        ensure_project_page(driver).refresh()
+
+    def _reload(self, driver: WebDriver):
+        self._switch_to_handle(driver)
+        load_project_page(driver)
+
+    def _restart(self, driver: WebDriver):
+        if self.before_restart is not None:
+            self.before_restart(driver)
+        restart_browser(driver)
+        self.register(driver)
+
+    def report(self) -> str:
+        lines = []
+        with self._lock:
+            for failure, stats in sorted(self.stats.items()):
+                remedies = ", ".join(
+                    f"{remedy}: {count}"
+                    for remedy, count in stats["remedies"].most_common()
+                )
+                lines.append(
+                    f"{failure}: {stats['count']} recoveries in"
+                    f" {stats['time']:.1f}s"
+                    f" (avg {stats['time'] / stats['count']:.1f}s;"
+                    f" {remedies})"
+                )
+        return "\n".join(lines)
@@ -1,16 +1,42 @@
-from typing import Optional
-from selenium.common.exceptions import TimeoutException
+from typing import Optional, Union
+from logging import getLogger
+from weakref import WeakSet
+
+from selenium.common.exceptions import TimeoutException, WebDriverException
 from selenium.webdriver.remote.webdriver import WebDriver
-from ss_crawler.exceptions import UnverifiedPage
+from selenium.webdriver.support.wait import WebDriverWait
+from ss_crawler.exceptions import (
+    RouteNotLanded,
+    SSCrawlerException,
+    UnverifiedPage,
+)
 
+from ss_crawler.health import HealthMonitor
+from ss_crawler.locators import ProjectPageLocators
 from ss_crawler.pages import LoginPage, MainPage, ProjectPage, Review
+from ss_crawler.utils.cache import ReviewCache
 from ss_crawler.utils.credentials import get_credentials
 from ss_crawler.utils.filesize import FileSize
-from ss_crawler.utils.webdriver import get_chrome_driver
+from ss_crawler.utils.session import restore_cookies, save_cookies
+from ss_crawler.utils.webdriver import get_chrome_driver, restart_session
 
 
 SYNCSKETCH = "https://syncsketch.com"
 
+LOGGED_IN = "logged_in"
+LOGGED_OUT = "logged_out"
+
+
+logger = getLogger(__name__)
+
+# drivers whose deep links did not land, see find_review
+_deep_link_missed: "WeakSet[WebDriver]" = WeakSet()
+
+
+def reset_deep_links():
+    # deep links are tried again from the start of a sync
+    _deep_link_missed.clear()
+
 
 def home_login(driver: WebDriver):
     driver.get(SYNCSKETCH)
@@ -22,19 +48,50 @@ def home_login(driver: WebDriver):
     return ProjectPage(driver)
 
 
+def get_auth_state(driver: WebDriver, wait: int = 10) -> str:
+    # waits for the page to settle on either the login or the project page
+    def _auth_state(_) -> Union[str, bool]:
+        if driver.title.strip() == "Log In":
+            return LOGGED_OUT
+        if driver.find_elements(*ProjectPageLocators.PROJECT_NAME):
+            return LOGGED_IN
+        return False
+
+    try:
+        return WebDriverWait(driver, wait).until(_auth_state)
+    except TimeoutException:
+        return LOGGED_OUT
+
+
 def load_project_page(driver: Optional[WebDriver] = None):
+    # Logs in only when neither the browser profile nor the saved session
+    # cookies are still authenticated
     if driver is None:
         driver = get_chrome_driver()
     cred = get_credentials()
     driver.get(cred["url"])
-    login_page = LoginPage(driver)
-    login_page.login(cred["email"], cred["password"])
-    return ProjectPage(driver)
+    state = get_auth_state(driver)
+    if state == LOGGED_OUT and restore_cookies(driver):
+        logger.info("Restoring the saved session")
+        driver.get(cred["url"])
+        state = get_auth_state(driver)
+    if state == LOGGED_OUT:
+        login_page = LoginPage(driver)
+        login_page.login(cred["email"], cred["password"])
+    project_page = ProjectPage(driver)
+    save_cookies(driver)
+    return project_page
+
+
+def restart_browser(driver: WebDriver) -> ProjectPage:
+    restart_session(driver)
+    return load_project_page(driver)
 
 
 def collect_file_sizes():
     driver = get_chrome_driver()
     project_page = load_project_page(driver)
+    monitor = HealthMonitor()
     project_page.scroll_to_end()
     all_sizes = []
     # random.choices(project_page.get_reviews(), k=10):
@@ -42,8 +99,12 @@ def collect_file_sizes():
     review_ids = [r.get_id() for r in project_page.get_reviews()]
     total_reviews = len(review_ids)
     for i, _id in enumerate(review_ids):
-        if i % 10 == 0:
-            project_page.refresh()
+        if i:
+            monitor.maintain(
+                driver,
+                project_page.refresh,
+                lambda: restart_browser(driver),
+            )
         review = project_page.get_review(_id)
         if review is None:
             print("review not found")
@@ -80,3 +141,26 @@ def get_all_reviews(driver: Optional[WebDriver] = None) -> list[Review]:
     project_page = ensure_project_page(driver)
     project_page.scroll_to_end()
     return project_page.get_reviews()
+
+
+def find_review(
+    project_page: ProjectPage, review_id: str, deep_link: bool = True
+) -> Review:
+    # After the first deep link that does not land the driver does not try
+    # the route again until reset_deep_links() is called
+    driver = project_page.driver
+    if deep_link and driver not in _deep_link_missed:
+        try:
+            return project_page.open_review(review_id)
+        except (SSCrawlerException, WebDriverException) as exc:
+            logger.warning(f"Deep link to review_{review_id} failed: {exc}")
+            if isinstance(exc, RouteNotLanded):
+                logger.info("Not using deep links for the rest of the sync")
+                _deep_link_missed.add(driver)
+            if project_page.get_route_review_id() is not None:
+                project_page.refresh()
+    review_cache = ReviewCache(review_id)
+    review_cache.load_data()
+    return project_page.get_review(
+        review_id, name=review_cache.data.get("name")
+    )
@@ -1,5 +1,7 @@
-from typing import Optional
+from concurrent.futures import Future
+from typing import Callable, Optional
 import collections
+import functools
 import os
 
 from tqdm import tqdm
@@ -8,45 +10,75 @@ from selenium.common.exceptions import WebDriverException
 from selenium.webdriver.remote.webdriver import WebDriver
 from ss_crawler.exceptions import DownloadNotDetected, SSCrawlerException
 
+from ss_crawler.conf import get_direct_transfer
+from ss_crawler.health import HealthMonitor
+from ss_crawler.pages import ReviewItem
+from ss_crawler.recovery import RecoveryPolicy
 from ss_crawler.scripts import (
     ensure_project_page,
-    get_all_reviews,
+    find_review,
     load_project_page,
+    reset_deep_links,
+    restart_browser,
 )
 from ss_crawler.utils.cache import ProjectCache, ReviewCache, ReviewItemCache
+from ss_crawler.utils.checksum import Checksum
 from ss_crawler.utils.credentials import get_project_id
+from ss_crawler.utils.index import notes_signature
+from ss_crawler.utils.download_management import DownloadPipeline
+from ss_crawler.utils.journal import STAGES, SyncJournal, open_journal
+from ss_crawler.utils.transfer import get_http_transfer
+from ss_crawler.workers import SyncWorkerPool
 
 
-def sync_project_data(driver: WebDriver) -> list[str]:
+def sync_project_data(
+    driver: WebDriver, changed_only: bool = False
+) -> list[str]:
+    # Only reviews whose data changed since the last run are written to the
+    # cache, with changed_only only the reviews whose fingerprint differs
+    # from the one they were last synced at are returned. The project is
+    # written once the whole list was read, so an interrupted run leaves
+    # the previous list of reviews in place.
     print("Syncing review ids ...")
     project_page = load_project_page(driver)
     project_id = project_page.get_id()
     project_data = project_page.get_data()
     project_cache = ProjectCache(project_id)
-    project_cache.data = project_data
-    reviews = get_all_reviews(driver)
-    total, new = 0, 0
+    previous_ids = []
+    if os.path.exists(project_cache.metadata_path):
+        project_cache.load_data()
+        previous_ids = [review["id"] for review in project_cache.reviews]
+    cached_data = project_cache.data
+    project_cache.data = {**cached_data, **project_data}
+    project_changed = project_cache.data != cached_data
+    project_cache.clear_reviews()
+    total, new, changed = 0, 0, 0
     review_ids = []
-    for idx in tqdm(range(0, len(reviews))):
-        review = reviews[idx]
-        total += 1
-        review_data = review.get_data()
-        review_id = review_data["id"]
-        review_ids.append(review_id)
-        review_cache = ReviewCache(review_id)
-        if os.path.exists(review_cache.metadata_path):
-            review_cache.load_data()
-            _data = review_cache.data
-            _data.update(review_data)
-            review_cache.data = _data
-        else:
-            new += 1
-        project_cache.append_review(review_data)
-        review_cache.store_data()
-    project_cache.store_data()
+    progress = tqdm(unit="reviews")
+    for batch in project_page.iter_review_data():
+        for review_data in batch:
+            total += 1
+            review_id = review_data["id"]
+            review_cache = ReviewCache(review_id)
+            if os.path.exists(review_cache.metadata_path):
+                review_cache.load_data()
+            else:
+                new += 1
+            if review_cache.update_seen(review_data):
+                changed += 1
+                review_cache.store_data()
+            if not changed_only or review_cache.needs_update:
+                review_ids.append(review_id)
+            project_cache.append_review(review_data)
+        progress.update(len(batch))
+    progress.close()
+    all_ids = [review["id"] for review in project_cache.reviews]
+    if project_changed or changed or all_ids != previous_ids:
+        project_cache.store_data()
     print(
         f"Data for project_{project_id} synced! ..."
-        f"\n\t... {new} of {total} reviews are new!"
+        f"\n\t... {new} of {total} reviews are new,"
+        f" {changed} changed since the last run!"
     )
     return review_ids
 
@@ -54,34 +86,104 @@ def sync_project_data(driver: WebDriver) -> list[str]:
 def sync_review_data(driver: WebDriver, review_id: str):
     project_page = ensure_project_page(driver)
     print(f"Syncing data for review_{review_id}...")
-    review = project_page.get_review(review_id)
+    review = find_review(project_page, review_id)
     review_data = review.get_data()
-    review_cache = ReviewCache(review_data["id"], data=review_data)
-    for review_item in review.get_review_items():
-        review_item_data = review_item.get_data()
+    review_cache = ReviewCache(review_data["id"])
+    if os.path.exists(review_cache.metadata_path):
+        review_cache.load_data()
+    notes = notes_signature(review_cache.review_items)
+    review_cache.data = {**review_cache.data, **review_data}
+    # recorded when the media was stored, the page knows nothing of them
+    checksum_sizes = {
+        item["id"]: item["checksum_size"]
+        for item in review_cache.review_items
+        if "checksum_size" in item
+    }
+    review_cache.clear_review_items()
+    for review_item_data in review.get_review_items_data():
+        if review_item_data["id"] in checksum_sizes:
+            review_item_data["checksum_size"] = checksum_sizes[
+                review_item_data["id"]
+            ]
         review_cache.append_review_item(review_item_data)
+    review_cache.mark_synced()
     review_cache.store_data()
+    if notes_signature(review_cache.review_items) != notes:
+        print(f"Notes of review_{review_id} changed")
 
 
-def sync_review_files(driver: WebDriver, review_id: str):
+def sync_review_files(
+    driver: WebDriver, review_id: str, stale_only: bool = False
+):
+    # with stale_only only the exports missing from the cache or stored
+    # before the notes of the review changed are downloaded
     print(f"Downoading files for review_{review_id}")
+    download_csv, download_zip = True, True
+    if stale_only:
+        cached = ReviewCache(review_id)
+        cached.load_data()
+        download_csv = cached.needs_csv_refresh
+        download_zip = cached.needs_zip_refresh
+        if not (download_csv or download_zip):
+            print(f"Files for review_{review_id} are up to date")
+            return
     project_page = ensure_project_page(driver)
-    review = project_page.get_review(review_id)
+    review = find_review(project_page, review_id)
     print(f"found review {review.get_id()}")
     review_data = review.get_data()
     review_cache = ReviewCache(review_data["id"], data=review_data)
-    csv = review.download_csv()
-    csv_cache = review_cache.store_file(csv)
-    print(f"Downloaded file: {csv}  - stored at {csv_cache}")
-    sketch = review.download_sketches()
-    sketch_cache = review_cache.store_file(sketch)
-    print(f"Download file: {sketch} - stored at {sketch_cache}")
+    if download_csv:
+        csv = review.download_csv()
+        csv_cache = review_cache.store_file(csv)
+        print(f"Downloaded file: {csv}  - stored at {csv_cache}")
+    if download_zip:
+        sketch = review.download_sketches()
+        sketch_cache = review_cache.store_file(sketch)
+        print(f"Download file: {sketch} - stored at {sketch_cache}")
 
 
-def sync_review_items_media(driver: WebDriver, review_id: str):
+def store_review_item_media(
+    review_item_cache: ReviewItemCache,
+    media: str,
+    checksum: Optional[Checksum] = None,
+):
+    media_cache = review_item_cache.store_media(media, checksum)
+    review_item_cache.store_data()
+    print(f"Download file: {media} - stored at {media_cache}")
+    return media_cache
+
+
+def sync_review_items_media(
+    driver: WebDriver,
+    review_id: str,
+    pipeline: Optional[DownloadPipeline] = None,
+    retry_ids: Optional[set[str]] = None,
+    direct_transfer: Optional[bool] = None,
+):
+    # With a pipeline the browser only starts each download and the
+    # pipeline stores it in the cache once complete. With direct_transfer
+    # the original media is fetched over http into the cache, falling back
+    # to the browser download when its url cannot be found or fetched.
+    # Transfers failing in the pipeline add the review to retry_ids, for
+    # its media to be downloaded with the browser once the pipeline is
+    # joined.
+    if direct_transfer is None:
+        direct_transfer = get_direct_transfer()
+    transfer = get_http_transfer() if direct_transfer else None
     project_page = ensure_project_page(driver)
     print(f"Downoading media for review_{review_id}")
-    review = project_page.get_review(review_id)
+    review = find_review(project_page, review_id)
+    # items already in the cache are checked against the scan of the
+    # review rather than by probing their media and metadata one by one
+    review_cache = ReviewCache(review_id)
+    review_cache.load_data()
+    status = review_cache.get_status()
+    cached_items = {item["id"]: item for item in review_cache.review_items}
+
+    def _on_transfer_done(future: Future):
+        if future.exception() is not None and retry_ids is not None:
+            retry_ids.add(review_id)
+
     for review_item in review.get_review_items():
         review_item_data = review_item.get_data()
         review_item_cache = ReviewItemCache(
@@ -89,14 +191,70 @@ def sync_review_items_media(driver: WebDriver, review_id: str):
             review_item_data["review_id"],
             review_item_data,
         )
-        if review_item_cache.needs_download:
+        cached_item = cached_items.get(review_item_data["id"])
+        if cached_item is not None:
+            needs_download = status.needs_download(
+                {
+                    **review_item_data,
+                    "checksum_size": cached_item.get("checksum_size"),
+                }
+            )
+        else:
+            needs_download = review_item_cache.needs_download
+        if not needs_download:
+            continue
+        if transfer is not None:
             try:
-                media = review_item.download_original()
-            except DownloadNotDetected:
-                media = review_item.download_transcoded()
-            media_cache = review_item_cache.store_media(media)
-            review_item_cache.store_data()
-            print(f"Download file: {media} - stored at {media_cache}")
+                pending = review_item.transfer_original(
+                    transfer,
+                    review_item_cache.media_path,
+                    detach=True,
+                )
+                # filled as the transfer runs, in the pipeline with detach
+                store = functools.partial(
+                    store_review_item_media,
+                    review_item_cache,
+                    checksum=pending.checksum,
+                )
+                if pipeline is None:
+                    store(pending.run())
+                else:
+                    future = pipeline.submit(pending, store)
+                    future.add_done_callback(_on_transfer_done)
+                continue
+            except (SSCrawlerException, WebDriverException) as exc:
+                print(f"Direct transfer failed, using the browser: {exc}")
+        _download_review_item_media(review_item, review_item_cache, pipeline)
+    if pipeline is None:
+        _record_checksum_sizes([review_id])
+
+
+def _record_checksum_sizes(review_ids: list[str]):
+    # once the media of the reviews is in the cache
+    for review_id in review_ids:
+        review_cache = ReviewCache(review_id)
+        if not os.path.exists(review_cache.metadata_path):
+            continue
+        review_cache.load_data()
+        if review_cache.record_checksum_sizes():
+            review_cache.store_data()
+
+
+def _download_review_item_media(
+    review_item: ReviewItem,
+    review_item_cache: ReviewItemCache,
+    pipeline: Optional[DownloadPipeline] = None,
+):
+    detach = pipeline is not None
+    try:
+        media = review_item.download_original(detach=detach)
+    except DownloadNotDetected:
+        media = review_item.download_transcoded(detach=detach)
+    store = functools.partial(store_review_item_media, review_item_cache)
+    if pipeline is None:
+        store(media)
+    else:
+        pipeline.submit(media, store)
 
 
 def sync_review(
@@ -105,15 +263,58 @@ def sync_review(
     sync_data=True,
     sync_files=True,
     sync_media=True,
+    pipeline: Optional[DownloadPipeline] = None,
+    stale_only: bool = False,
+    journal: Optional[SyncJournal] = None,
+    step: str = "reviews",
+    retry_ids: Optional[set[str]] = None,
 ):
+    # With a journal the stages already done for the review are skipped and
+    # every stage is recorded as it starts, completes or fails
     if not any([sync_data, sync_files, sync_media]):
         raise AttributeError("Please specify atleast one operation")
+    stages = []
     if sync_data:
-        sync_review_data(driver, review_id)
+        stages.append(
+            ("data", functools.partial(sync_review_data, driver, review_id))
+        )
     if sync_files:
-        sync_review_files(driver, review_id)
+        stages.append(
+            (
+                "files",
+                functools.partial(
+                    sync_review_files, driver, review_id, stale_only
+                ),
+            )
+        )
     if sync_media:
-        sync_review_items_media(driver, review_id)
+        stages.append(
+            (
+                "media",
+                functools.partial(
+                    sync_review_items_media,
+                    driver,
+                    review_id,
+                    pipeline,
+                    retry_ids,
+                ),
+            )
+        )
+    for stage, run in stages:
+        if journal is None:
+            run()
+            continue
+        if journal.is_done(step, review_id, stage):
+            continue
+        journal.start(step, review_id, stage)
+        try:
+            run()
+        except BaseException as exc:
+            journal.fail(step, review_id, stage, repr(exc))
+            raise
+        # media handed to a pipeline is only done once it is in the cache
+        if not (stage == "media" and pipeline is not None):
+            journal.done(step, review_id, stage)
 
 
 def sync_reviews(
@@ -123,40 +324,170 @@ def sync_reviews(
     sync_media=False,
     review_ids: Optional[list[str]] = None,
     max_tries: int = 3,
+    workers: int = 1,
+    stale_only: bool = False,
+    journal: Optional[SyncJournal] = None,
+    step: str = "reviews",
 ):
+    # A journal that already holds the step resumes its unfinished reviews
+    # instead of review_ids
     if not any([sync_data, sync_files, sync_media]):
         raise AttributeError("Must specify atleast one operation")
+    if journal is not None and journal.has_step(step):
+        review_ids = journal.pending(step)
+        print(f"Resuming {step} with {len(review_ids)} reviews left ...")
+    else:
+        if review_ids is None:
+            review_ids = sync_project_data(driver)
+        if journal is not None:
+            stages = [
+                stage
+                for stage, enabled in zip(
+                    STAGES, (sync_data, sync_files, sync_media)
+                )
+                if enabled
+            ]
+            review_ids = journal.begin_step(step, review_ids, stages)
+    if not review_ids:
+        return
+    reset_deep_links()
+    pipeline = None
+    # reviews whose direct transfers failed in the pipeline
+    retry_ids = set()
+    if sync_media:
+        pipeline = DownloadPipeline(threads=workers)
+        pipeline.start()
+    job = functools.partial(
+        sync_review,
+        sync_data=sync_data,
+        sync_files=sync_files,
+        sync_media=sync_media,
+        pipeline=pipeline,
+        stale_only=stale_only,
+        journal=journal,
+        step=step,
+        retry_ids=retry_ids,
+    )
+    try:
+        if workers > 1:
+            pool = SyncWorkerPool(
+                workers, max_tries=max_tries, pipeline=pipeline
+            )
+            failed = pool.run(review_ids, job)
+            if failed:
+                print(f"{len(failed)} reviews failed after {max_tries} tries")
+        else:
+            _sync_reviews_serial(
+                driver, review_ids, job, max_tries, journal, step, pipeline
+            )
+    finally:
+        if pipeline is not None:
+            print("Waiting for pending downloads ...")
+            pipeline.join()
+            _record_checksum_sizes(review_ids)
+            if journal is not None:
+                _journal_media(journal, step, review_ids)
+    if retry_ids:
+        retry_ids = sorted(retry_ids)
+        _sync_media_with_browser(driver, retry_ids)
+        if journal is not None:
+            _journal_media(journal, step, retry_ids)
+
+
+def _sync_media_with_browser(driver: WebDriver, review_ids: list[str]):
+    print(f"Downloading {len(review_ids)} failed transfers with the browser")
+    for review_id in review_ids:
+        try:
+            sync_review_items_media(driver, review_id, direct_transfer=False)
+        except (SSCrawlerException, WebDriverException) as exc:
+            print(f"review_{review_id} errored with exception", exc)
+
+
+def _journal_media(journal: SyncJournal, step: str, review_ids: list[str]):
+    # the media stage of a review is done once all its media is cached
+    for review_id in review_ids:
+        if journal.is_done(step, review_id, "media"):
+            continue
+        review_cache = ReviewCache(review_id)
+        review_cache.load_data()
+        if not review_cache.needs_media:
+            journal.done(step, review_id, "media")
+        else:
+            journal.fail(step, review_id, "media", "media not in the cache")
+
+
+def _sync_reviews_serial(
+    driver: WebDriver,
+    review_ids: list[str],
+    job: Callable[[WebDriver, str], None],
+    max_tries: int,
+    journal: Optional[SyncJournal] = None,
+    step: str = "reviews",
+    pipeline: Optional[DownloadPipeline] = None,
+):
     project_page = ensure_project_page(driver)
-    if review_ids is None:
-        review_ids = sync_project_data(driver)
-    my_handle = driver.current_window_handle
+
+    def _drain(_: WebDriver):
+        # the downloads the browser writes for the pipeline would be cut
+        # short by a restart
+        if pipeline is not None:
+            pipeline.drain()
+
+    recovery = RecoveryPolicy(before_restart=_drain)
+    recovery.register(driver)
+    monitor = HealthMonitor()
     to_sync = review_ids[:]
     tries = collections.defaultdict(int)
+    failed = []
     while to_sync:
         to_sync, rids = [], to_sync
         print(f"Syncing for {len(rids)} reviews ...")
         for idx, review_id in enumerate(rids):
-            if (idx + 1) % 10 == 0:
-                project_page.refresh()
-                project_page.scroll_to_end()
+            if idx:
+                monitor.maintain(
+                    driver,
+                    project_page.refresh,
+                    functools.partial(_restart_browser, recovery, driver),
+                )
             try:
                 print(f"Syncing {idx+1} of {len(rids)} ...")
-                sync_review(
-                    driver, review_id, sync_data, sync_files, sync_media
-                )
+                job(driver, review_id)
             except (SSCrawlerException, WebDriverException) as exc:
                 print(f"review_{review_id} errored with exception", exc)
                 import traceback
 
                 traceback.print_exc()
                 tries[review_id] += 1
+                try:
+                    recovery.recover(driver, exc, tries[review_id])
+                except (SSCrawlerException, WebDriverException) as rexc:
+                    # the browser could not be brought back for this review,
+                    # the ones after it still get their chance
+                    print(f"Could not recover from review_{review_id}", rexc)
+                    traceback.print_exc()
+                    tries[review_id] = max_tries
+                    if journal is not None:
+                        journal.fail_review(
+                            step, review_id, f"recovery failed: {rexc!r}"
+                        )
                 if tries[review_id] < max_tries:
                     to_sync.append(review_id)
-                driver.switch_to.window(my_handle)
-                project_page.refresh()
-                project_page.scroll_to_end()
+                else:
+                    failed.append(review_id)
         if to_sync:
             print(f"Trying {len(to_sync)} from those errored out!")
+    if failed:
+        print(f"{len(failed)} reviews failed: {', '.join(failed)}")
+    report = recovery.report()
+    if report:
+        print(f"Recoveries:\n{report}")
+
+
+def _restart_browser(recovery: RecoveryPolicy, driver: WebDriver):
+    if recovery.before_restart is not None:
+        recovery.before_restart(driver)
+    restart_browser(driver)
+    recovery.register(driver)
 
 
 def sync_by_steps(
@@ -164,55 +495,133 @@ def sync_by_steps(
     sync_data=False,
     sync_files=False,
     sync_media=False,
+    resume: bool = True,
 ):
     if not any([sync_data, sync_files, sync_media]):
         raise AttributeError("Must specify atleast one operation")
-    review_ids = sync_project_data(driver)
-    if sync_data:
-        sync_reviews(driver, sync_data=True, review_ids=review_ids)
-    if sync_files:
-        sync_reviews(driver, sync_files=True, review_ids=review_ids)
-    if sync_media:
-        sync_reviews(driver, sync_media=True, review_ids=review_ids)
+    journal = open_journal("sync_by_steps", resume)
+    review_ids = journal.get_review_ids("project")
+    if review_ids is None:
+        review_ids = sync_project_data(driver)
+        journal.begin_step("project", review_ids, [])
+    for step, enabled in zip(STAGES, (sync_data, sync_files, sync_media)):
+        if enabled:
+            sync_reviews(
+                driver,
+                review_ids=review_ids,
+                journal=journal,
+                step=step,
+                **{f"sync_{step}": True},
+            )
+    _finish_journal(journal)
 
 
-def sync_from_cache(driver: WebDriver, refresh_ids=False):
+def _finish_journal(journal: SyncJournal):
+    if journal.is_complete():
+        for step, review_id, stage, error in journal.exhausted():
+            print(
+                f"Gave up on {stage} of review_{review_id} in {step}:", error
+            )
+        journal.finish()
+        return
+    print(
+        f"Jobs left unfinished in {journal.path},"
+        " run the sync again to resume them"
+    )
+
+
+def sync_from_cache(
+    driver: WebDriver,
+    refresh_ids=False,
+    workers: int = 1,
+    journal: Optional[SyncJournal] = None,
+):
     cache = ProjectCache(get_project_id())
-    cache_reviews = cache.get_reviews()
-    cache.filter_reviews
+    # the index answers these directly, without it the reviews are loaded
+    # once from the cache tree and filtered in memory
+    cache_reviews = None
+    if cache.get_review_index() is None:
+        cache_reviews = cache.get_reviews()
+
+    def _get_review_ids(step: str, key: str) -> Optional[list[str]]:
+        # steps the journal holds are resumed from it
+        if journal is not None and journal.has_step(step):
+            return None
+        return cache.filter_review_ids(key=key, reviews=cache_reviews)
+
     sync_reviews(
         driver,
         sync_data=True,
-        review_ids=[
-            r._id
-            for r in cache.filter_reviews(
-                key="needs_data_sync", reviews=cache_reviews
-            )
-        ],
+        review_ids=_get_review_ids("cache_data", "needs_data_sync"),
+        workers=workers,
+        journal=journal,
+        step="cache_data",
     )
     sync_reviews(
         driver,
         sync_files=True,
-        review_ids=[
-            r._id
-            for r in cache.filter_reviews(
-                key="needs_files", reviews=cache_reviews
-            )
-        ],
+        review_ids=_get_review_ids("cache_files", "needs_files_refresh"),
+        workers=workers,
+        stale_only=True,
+        journal=journal,
+        step="cache_files",
     )
     sync_reviews(
         driver,
         sync_media=True,
-        review_ids=[
-            r._id
-            for r in cache.filter_reviews(
-                key="needs_media", reviews=cache_reviews
-            )
-        ],
+        review_ids=_get_review_ids("cache_media", "needs_media"),
+        workers=workers,
+        journal=journal,
+        step="cache_media",
     )
 
 
-def complete_sync(driver):
-    sync_project_data(driver)
-    sync_reviews(driver, sync_data=True, sync_files=True)
-    sync_from_cache(driver)
+def _has_exports(review: ReviewCache) -> bool:
+    return not (review.needs_csv and review.needs_zip)
+
+
+def complete_sync(
+    driver, workers: int = 1, resume: bool = True, check_notes: bool = False
+):
+    # Only new and changed reviews are synced again, reviews missing data,
+    # files or media are picked up by sync_from_cache. Notes edits do not
+    # show on the project page, with check_notes the items of the other
+    # reviews with exports are read again so that exports whose notes
+    # changed are refreshed by sync_from_cache. That visits every such
+    # review in the browser, so it is meant for an occasional run rather
+    # than the nightly one.
+    journal = open_journal("complete_sync", resume)
+    review_ids = journal.get_review_ids("project")
+    if review_ids is None:
+        review_ids = sync_project_data(driver, changed_only=True)
+        journal.begin_step("project", review_ids, [])
+    sync_reviews(
+        driver,
+        sync_data=True,
+        sync_files=True,
+        review_ids=review_ids,
+        workers=workers,
+        journal=journal,
+        step="changed",
+    )
+    if check_notes:
+        notes_ids = None
+        if not journal.has_step("notes"):
+            changed_ids = set(review_ids)
+            notes_ids = [
+                review_id
+                for review_id in ProjectCache(
+                    get_project_id()
+                ).filter_review_ids(key=_has_exports)
+                if review_id not in changed_ids
+            ]
+        sync_reviews(
+            driver,
+            sync_data=True,
+            review_ids=notes_ids,
+            workers=workers,
+            journal=journal,
+            step="notes",
+        )
+    sync_from_cache(driver, workers=workers, journal=journal)
+    _finish_journal(journal)
@@ -1,18 +1,36 @@
+from concurrent.futures import ThreadPoolExecutor
 from fnmatch import fnmatch
 import json
 import os
 import re
 import shutil
 import csv
+import threading
 from types import FunctionType
 from typing import Literal, Optional, Union
 from datetime import datetime
-from zipfile import ZipFile
 
+from ss_crawler.utils.checksum import Checksum, verify_file, verify_files
+from ss_crawler.utils.credentials import get_project_id
 from ss_crawler.utils.filesize import FileSize
-
-
-from ..conf import get_cache_location, DEFAULT_CONF_PATH
+from ss_crawler.utils.index import (
+    FILE_COUNT_KEYS,
+    CacheIndex,
+    get_cache_index,
+    load_checksum,
+    notes_signature,
+)
+from ss_crawler.utils.ingest import ingest_file
+from ss_crawler.utils.notes import NotesStore, get_notes_store
+from ss_crawler.utils.sketches import SketchArchive
+
+from ..exceptions import CacheException
+from ..conf import (
+    get_cache_location,
+    get_ingest_mode,
+    get_use_index,
+    DEFAULT_CONF_PATH,
+)
 
 
 DATETIME_ARCHIVE_FORMAT = "%Y%m%d_%H%M%S_%f"
@@ -20,6 +38,37 @@ REVIEW_RE = r"^review_(\d+)$"
 REVIEW_ITEM_RE = r"^item_(\d+)$"
 
 
+def count_csv_notes(csv_path: str) -> int:
+    num_notes = 0
+    with open(csv_path) as csv_file:
+        csv_reader = csv.reader(csv_file, delimiter=",")
+        for idx, _ in enumerate(csv_reader):
+            if idx == 0:
+                continue
+            num_notes += 1
+    return num_notes
+
+
+def count_zip_sketches(zip_path: str) -> int:
+    return len(SketchArchive(zip_path).names())
+
+
+# counts persisted in the review metadata for each stored file kind
+FILE_COUNTERS = {
+    "csv": (FILE_COUNT_KEYS["csv"], count_csv_notes),
+    "zip": (FILE_COUNT_KEYS["zip"], count_zip_sketches),
+}
+
+
+# review data compared between runs to detect changed reviews, these are
+# the fields the project page shows for each review
+FINGERPRINT_KEYS = ("name", "item_count")
+
+
+def review_fingerprint(review_data: dict) -> str:
+    return json.dumps([review_data.get(key) for key in FINGERPRINT_KEYS])
+
+
 def make_serializable(data: dict) -> dict:
     serializable = {}
     for key, value in data.items():
@@ -60,6 +109,20 @@ class Cache(object):
     def cache_base_dir(self):
         return get_cache_location(self._conf)
 
+    @property
+    def ingest_mode(self) -> str:
+        return get_ingest_mode(self._conf)
+
+    @property
+    def index(self) -> Optional[CacheIndex]:
+        if get_use_index(self._conf):
+            return get_cache_index(self.cache_base_dir)
+        return None
+
+    @property
+    def notes_store(self) -> NotesStore:
+        return get_notes_store(self.cache_base_dir)
+
 
 class ItemCache(Cache):
     cache_dir: str
@@ -97,10 +160,20 @@ class ItemCache(Cache):
         data["id"] = self._id
         metadata_path = self.metadata_path
         data = make_serializable(data)
-        with open(metadata_path, "w+") as data_file:
+        # replaced in one step so that readers never see a partial file
+        tmp_path = f"{metadata_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as data_file:
             json.dump(data, data_file, indent=2)
+        os.replace(tmp_path, metadata_path)
+        index = self.index
+        if index is not None:
+            self.update_index(index, data)
         return metadata_path
 
+    def update_index(self, index: CacheIndex, data: dict):
+        # data is the serialized metadata just stored
+        pass
+
     def _load_data(self) -> dict:
         data = {}
         if os.path.exists(self.metadata_path):
@@ -123,14 +196,12 @@ class ItemCache(Cache):
             os.makedirs(self.cache_dir)
         return self.cache_dir
 
-    def store_file(self, path):
+    def store_file(self, path, checksum: Optional[Checksum] = None):
         _, ext = os.path.splitext(path)
         file_path = os.path.join(self.cache_dir, f"review_{self._id}{ext}")
         if not os.path.exists(self.cache_dir):
             os.makedirs(self.cache_dir)
-        if os.path.isfile(file_path):
-            os.unlink(file_path)
-        shutil.copy2(path, file_path)
+        ingest_file(path, file_path, self.ingest_mode, checksum=checksum)
         return file_path
 
     def has_file(self, pattern: str) -> str:
@@ -145,12 +216,89 @@ class ItemCache(Cache):
         return ""
 
 
+class ReviewStatus(object):
+    # Filesystem state of a review directory gathered in a single scandir
+    # pass: the files it holds and the mtime and size of each review item's
+    # media
+    def __init__(
+        self,
+        files: dict[str, tuple[int, float]],
+        media_mtimes: dict[str, float],
+        media_sizes: Optional[dict[str, int]] = None,
+    ):
+        # files maps paths to their (size, mtime)
+        self.files = files
+        self.media_mtimes = media_mtimes
+        self.media_sizes = media_sizes or {}
+
+    @classmethod
+    def scan(
+        cls, cache_dir: str, review_items: list[dict]
+    ) -> "ReviewStatus":
+        files = {}
+        item_dirs = {}
+        try:
+            entries = os.scandir(cache_dir)
+        except FileNotFoundError:
+            entries = None
+        if entries is not None:
+            with entries:
+                for entry in entries:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        files[entry.path] = (stat.st_size, stat.st_mtime)
+                    elif entry.is_dir():
+                        item_dirs[entry.name] = entry.path
+        media_mtimes = {}
+        media_sizes = {}
+        for item in review_items:
+            mtime = 0.0
+            item_dir = item_dirs.get(f"item_{item['id']}")
+            if item_dir is not None and item.get("name"):
+                media_path = os.path.join(item_dir, item["name"])
+                try:
+                    stat = os.stat(media_path)
+                except OSError:
+                    pass
+                else:
+                    mtime = stat.st_mtime
+                    media_sizes[item["id"]] = stat.st_size
+            media_mtimes[item["id"]] = mtime
+        return cls(files, media_mtimes, media_sizes)
+
+    def has_file(self, pattern: str) -> str:
+        for path in self.files:
+            if fnmatch(os.path.basename(path), pattern):
+                return path
+        return ""
+
+    def covers(self, review_items: list[dict]) -> bool:
+        return all(item["id"] in self.media_mtimes for item in review_items)
+
+    def is_truncated(self, review_item: dict) -> bool:
+        # against the checksum size recorded in the review item, see
+        # ReviewCache.record_checksum_sizes
+        checksum_size = review_item.get("checksum_size")
+        media_size = self.media_sizes.get(review_item["id"])
+        if checksum_size is None or media_size is None:
+            return False
+        return media_size != checksum_size
+
+    def needs_download(self, review_item: dict) -> bool:
+        mtime = datetime.fromtimestamp(self.media_mtimes[review_item["id"]])
+        upload_time = review_item.get(
+            "upload_time", datetime.fromtimestamp(0)
+        )
+        return mtime < upload_time or self.is_truncated(review_item)
+
+
 class ReviewCache(ItemCache):
     def __init__(
         self, id: str, data: Optional[dict] = None, conf: Optional[str] = None
     ):
         super().__init__(id, data, conf)
         self._review_items = []
+        self._status = None
 
     @property
     def cache_dir(self):
@@ -167,18 +315,173 @@ class ReviewCache(ItemCache):
         self._dirty = False
         return datafile
 
-    def load_data(self):
-        data = self._load_data()
+    def load_data(self, serialized: Optional[dict] = None):
+        # serialized metadata, e.g. from the index, saves reading the file
+        if serialized is None:
+            data = self._load_data()
+        else:
+            data = make_unserializable(serialized)
         if "review_items" in data:
             self._review_items = data["review_items"]
             del data["review_items"]
         self._data = data
         self._dirty = False
+        self._status = None
+
+    def update_index(self, index: CacheIndex, data: dict):
+        index.store_review(data)
+
+    def update_seen(self, review_data: dict) -> bool:
+        # Merges the review data seen on the project page, returns whether
+        # it differs from what the cache already holds
+        fingerprint = review_fingerprint(review_data)
+        changed = self._data.get("fingerprint") != fingerprint or any(
+            self._data.get(key) != value for key, value in review_data.items()
+        )
+        if changed:
+            self._data.update(review_data)
+            self._data["fingerprint"] = fingerprint
+            self._dirty = True
+        return changed
+
+    def mark_synced(self):
+        # the review data and items in the cache match the fingerprint
+        fingerprint = review_fingerprint(self._data)
+        self._data["fingerprint"] = fingerprint
+        self._data["synced_fingerprint"] = fingerprint
+        self._dirty = True
+
+    def store_file(self, path, checksum: Optional[Checksum] = None):
+        if checksum is None:
+            checksum = Checksum()
+        file_path = super().store_file(path, checksum)
+        self._status = None
+        kind = os.path.splitext(file_path)[1][1:]
+        if kind in FILE_COUNTERS:
+            record = self._make_file_record(file_path)
+            record["checksum"] = checksum.to_dict()
+            self._store_file_record(kind, record, new_export=True)
+        return file_path
+
+    def _make_file_record(self, file_path: str) -> dict:
+        kind = os.path.splitext(file_path)[1][1:]
+        key, counter = FILE_COUNTERS[kind]
+        stat = os.stat(file_path)
+        return {
+            "name": os.path.basename(file_path),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            key: counter(file_path),
+        }
+
+    def _store_file_record(
+        self, kind: str, record: dict, new_export: bool = False
+    ):
+        # Updates the metadata on disk rather than storing this instance,
+        # which may not hold the review items. Only a new export is known
+        # to match the notes of the review items, records of files found
+        # in the cache are left without a notes key.
+        if os.path.exists(self.metadata_path):
+            stored = self._load_data()
+        else:
+            stored = self._data.copy()
+            stored["review_items"] = self._review_items[:]
+        if new_export:
+            notes_total, notes_key = notes_signature(
+                stored.get("review_items", [])
+            )
+            record["notes_total"] = notes_total
+            record["notes_key"] = notes_key
+        files = stored.get("files", {})
+        files[kind] = record
+        stored["files"] = files
+        self._store_data(stored)
+        self._data["files"] = files
+        index = self.index
+        if index is not None:
+            key, _ = FILE_COUNTERS[kind]
+            index.store_review_file(
+                self._id,
+                kind,
+                os.path.join(self.cache_dir, record["name"]),
+                record[key],
+                record.get("notes_key"),
+            )
+
+    def get_file_count(self, kind: str) -> int:
+        # Served from the metadata while the file is unchanged, otherwise
+        # counted again and persisted
+        key, _ = FILE_COUNTERS[kind]
+        status = self.get_status()
+        file_path = status.has_file(f"*.{kind}")
+        if not file_path:
+            return 0
+        size, mtime = status.files[file_path]
+        record = self._data.get("files", {}).get(kind)
+        if (
+            record is not None
+            and key in record
+            and record.get("name") == os.path.basename(file_path)
+            and record.get("size") == size
+            and record.get("mtime") == mtime
+        ):
+            return record[key]
+        record = self._make_file_record(file_path)
+        self._store_file_record(kind, record)
+        return record[key]
+
+    def is_file_stale(self, kind: str) -> bool:
+        # Whether the notes of the review items changed since the export
+        # was stored, exports stored without the notes key compare the
+        # number of notes in the csv
+        record = self._data.get("files", {}).get(kind)
+        if record is None:
+            return False
+        notes_total, notes_key = notes_signature(self._review_items)
+        if record.get("notes_key") is not None:
+            return record["notes_key"] != notes_key
+        if kind == "csv" and record.get("num_notes") is not None:
+            return record["num_notes"] != notes_total
+        return False
+
+    def get_status(self, refresh: bool = False) -> ReviewStatus:
+        # The scan is kept until files are stored through this cache or
+        # review items are added that it has not seen
+        if (
+            refresh
+            or self._status is None
+            or not self._status.covers(self._review_items)
+        ):
+            self._status = ReviewStatus.scan(
+                self.cache_dir, self._review_items
+            )
+        return self._status
 
     @property
     def review_items(self):
         return self._review_items[:]
 
+    def record_checksum_sizes(self) -> bool:
+        # Copies the size of the checksum recorded with each cached media
+        # into its review item, so that scans tell truncated media apart
+        # without reading the metadata of every item. Returns whether any
+        # review item changed.
+        status = self.get_status()
+        changed = False
+        for item in self._review_items:
+            if item["id"] not in status.media_sizes:
+                continue
+            checksum = load_checksum(
+                os.path.join(self.cache_dir, f"item_{item['id']}")
+            )
+            size = checksum["size"] if checksum is not None else None
+            if item.get("checksum_size") != size:
+                item["checksum_size"] = size
+                changed = True
+        if changed:
+            self._dirty = True
+        return changed
+
     def clear_review_items(self):
         self._review_items.clear()
         self._dirty = True
@@ -188,58 +491,61 @@ class ReviewCache(ItemCache):
         self._dirty = True
 
     def get_num_notes(self) -> int:
-        num_notes = 0
-        csv_path = self.has_file("*.csv")
-        if csv_path:
-            with open(csv_path) as csv_file:
-                csv_reader = csv.reader(csv_file, delimiter=",")
-                for idx, _ in enumerate(csv_reader):
-                    if idx == 0:
-                        continue
-                    num_notes += 1
-        return num_notes
+        return self.get_file_count("csv")
+
+    def update_notes(self) -> bool:
+        # parses the csv into the notes store when it changed since the
+        # last time, returns whether it was parsed
+        csv_path = self.get_status().has_file("*.csv")
+        if not csv_path:
+            return False
+        return self.notes_store.update(
+            self._id, csv_path, self._review_items
+        )
 
     def get_notes(self) -> list[dict]:
-        notes = []
-        csv_path = self.has_file("*.csv")
-        if csv_path:
-            with open(csv_path) as csv_file:
-                csv_reader = csv.DictReader(csv_file, delimiter=",")
-                for idx, row in enumerate(csv_reader):
-                    if idx == 0:
-                        continue
-                    notes.append(row)
-        return notes
+        self.update_notes()
+        return self.notes_store.get_review_notes(self._id)
 
     def get_num_sketches(self) -> int:
-        num_sketches = 0
-        zip_path = self.has_file("*.zip")
-        if zip_path:
-            with ZipFile(zip_path) as _zip:
-                num_sketches = 0
-                num_sketches = sum(
-                    [
-                        1
-                        for fi in _zip.infolist()
-                        if not fi.is_dir()
-                        and os.path.splitext(fi.filename)[-1] == ".jpg"
-                    ]
-                )
-        return num_sketches
+        return self.get_file_count("zip")
+
+    @property
+    def sketch_dir(self):
+        return os.path.join(self.cache_dir, "sketches")
+
+    def get_sketch_archive(self) -> Optional[SketchArchive]:
+        zip_path = self.get_status().has_file("*.zip")
+        if not zip_path:
+            return None
+        return SketchArchive(zip_path)
 
     def get_sketches(self) -> list[str]:
-        sketches = []
-        zip_path = self.has_file("*.zip")
-        sketch_dir = os.path.join(self.cache_dir, "sketches")
-        if zip_path:
-            with ZipFile(zip_path) as _zip:
-                for file_info in _zip.infolist():
-                    extract_path = os.path.join(sketch_dir, file_info.filename)
-                    extract_dir = os.path.dirname(extract_path)
-                    if not os.path.exists(extract_dir):
-                        os.makedirs(extract_dir)
-                    _zip.extract(file_info.filename, extract_path)
-        return sketches
+        # names of the sketches in the review zip, nothing is extracted
+        archive = self.get_sketch_archive()
+        if archive is None:
+            return []
+        return archive.names()
+
+    def get_item_sketches(self) -> dict[str, list[str]]:
+        archive = self.get_sketch_archive()
+        if archive is None:
+            return {item["id"]: [] for item in self._review_items}
+        return archive.map_to_items(self._review_items)
+
+    def read_sketch(self, name: str) -> bytes:
+        archive = self.get_sketch_archive()
+        if archive is None:
+            raise CacheException(f"No sketches stored for review {self._id}")
+        return archive.read(name)
+
+    def extract_sketches(
+        self, names: Optional[list[str]] = None, workers: int = 4
+    ) -> list[str]:
+        archive = self.get_sketch_archive()
+        if archive is None:
+            return []
+        return archive.extract(self.sketch_dir, names, workers=workers)
 
     def get_review_item_caches(self):
         return [
@@ -249,33 +555,47 @@ class ReviewCache(ItemCache):
             for ridata in self._review_items
         ]
 
+    @property
+    def needs_update(self) -> bool:
+        return self._data.get("synced_fingerprint") != self._data.get(
+            "fingerprint"
+        )
+
     @property
     def needs_data_sync(self) -> bool:
         item_count = self._data.get("item_count")
         if item_count is None:
             return True
-        return item_count != len(self._review_items)
+        return item_count != len(self._review_items) or self.needs_update
 
     @property
     def needs_csv(self) -> bool:
-        return not bool(self.has_file("*.csv"))
+        return not bool(self.get_status().has_file("*.csv"))
 
     @property
     def needs_zip(self) -> bool:
-        return not bool(self.has_file("*.zip"))
+        return not bool(self.get_status().has_file("*.zip"))
 
     @property
     def needs_files(self) -> bool:
         return self.needs_zip or self.needs_csv
 
+    @property
+    def needs_csv_refresh(self) -> bool:
+        return self.needs_csv or self.is_file_stale("csv")
+
+    @property
+    def needs_zip_refresh(self) -> bool:
+        return self.needs_zip or self.is_file_stale("zip")
+
+    @property
+    def needs_files_refresh(self) -> bool:
+        return self.needs_csv_refresh or self.needs_zip_refresh
+
     @property
     def needs_media(self) -> bool:
-        return any(
-            [
-                ri_cache.needs_download
-                for ri_cache in self.get_review_item_caches()
-            ]
-        )
+        status = self.get_status()
+        return any(status.needs_download(item) for item in self._review_items)
 
     @property
     def is_complete(self) -> bool:
@@ -291,6 +611,11 @@ class ReviewCache(ItemCache):
     def remove(self):
         if os.path.exists(self.cache_dir):
             shutil.rmtree(self.cache_dir)
+        index = self.index
+        if index is not None:
+            index.remove_review(self._id)
+        self.notes_store.remove(self._id)
+        self._status = None
         self._dirty = True
 
 
@@ -331,9 +656,42 @@ class ReviewItemCache(ItemCache):
     def upload_time(self) -> datetime:
         return self._data.get("upload_time", datetime.fromtimestamp(0))
 
+    @property
+    def checksum(self) -> Optional[dict]:
+        # recorded when the media was stored, instances made from page data
+        # without one find it in the metadata on disk
+        if "checksum" in self._data:
+            return self._data["checksum"]
+        return self._load_data().get("checksum")
+
+    @property
+    def is_truncated(self) -> bool:
+        # only the size is compared, verify() compares the digest too
+        checksum = self.checksum
+        if checksum is None:
+            return False
+        try:
+            return os.path.getsize(self.media_path) != checksum["size"]
+        except OSError:
+            return False
+
     @property
     def needs_download(self) -> bool:
-        return self.mtime < self.upload_time
+        return self.mtime < self.upload_time or self.is_truncated
+
+    def record_checksum(self, checksum: Checksum):
+        # checksum_size only belongs to the review items of the review
+        self._data.pop("checksum_size", None)
+        self._data["checksum"] = checksum.to_dict()
+        self.store_data()
+
+    def verify(self) -> Optional[str]:
+        # why the media does not match its checksum, None when it does or
+        # no checksum was recorded
+        checksum = self.checksum
+        if checksum is None:
+            return None
+        return verify_file(self.media_path, checksum)
 
     @property
     def archive_dir(self):
@@ -346,15 +704,33 @@ class ReviewItemCache(ItemCache):
         self._dirty = False
         return datafile
 
-    def store_media(self, path):
+    def update_index(self, index: CacheIndex, data: dict):
+        index.store_review_item(data, self.media_path)
+
+    def store_media(self, path, checksum: Optional[Checksum] = None):
+        # checksum is that of media transferred straight into the cache,
+        # otherwise it is computed while the media is ingested
         filename = self.media_path
-        if os.path.exists(filename):
-            os.unlink(filename)
         _dir = os.path.dirname(filename)
         if not os.path.exists(_dir):
             os.makedirs(_dir)
-        shutil.copy2(path, self.media_path)
-        return self.media_path
+        if os.path.abspath(path) == filename:
+            if checksum is None:
+                checksum = Checksum.of_file(filename)
+        else:
+            checksum = Checksum()
+            ingest_file(path, filename, self.ingest_mode, checksum=checksum)
+            # left by a direct transfer that failed over to the browser
+            for partial in (f"{filename}.part", f"{filename}.part.json"):
+                if os.path.exists(partial):
+                    os.remove(partial)
+        self._data["checksum"] = checksum.to_dict()
+        index = self.index
+        if index is not None:
+            data = self._data.copy()
+            data.update(id=self._id, review_id=self._review_id)
+            index.store_review_item(make_serializable(data), filename)
+        return filename
 
 
 class ProjectCache(ItemCache):
@@ -389,6 +765,9 @@ class ProjectCache(ItemCache):
         self._dirty = False
         return datafile
 
+    def update_index(self, index: CacheIndex, data: dict):
+        index.store_project(data)
+
     @property
     def cache_dir(self):
         return self.cache_base_dir
@@ -399,19 +778,55 @@ class ProjectCache(ItemCache):
             self.cache_dir, f"project_{self._id}_metadata.json"
         )
 
-    def get_reviews(self) -> list[ReviewCache]:
+    def get_review_index(self) -> Optional[CacheIndex]:
+        # the index only answers queries once it has been rebuilt from the
+        # cache tree, until then it could be missing older reviews
+        index = self.index
+        if index is not None and index.is_built():
+            return index
+        return None
+
+    def rebuild_index(self) -> CacheIndex:
+        index = get_cache_index(self.cache_base_dir)
+        index.rebuild(
+            [
+                (review_id, os.path.join(self.cache_base_dir, basename))
+                for review_id, basename in self._get_review_dirs()
+            ]
+        )
+        if os.path.exists(self.metadata_path):
+            self.load_data()
+            data = self._data.copy()
+            data["id"] = self._id
+            index.store_project(make_serializable(data))
+        return index
+
+    def _get_review_dirs(self) -> list[tuple[str, str]]:
         base_dir = self.cache_base_dir
-        content = os.listdir(base_dir)
-        reviews = []
-        for basename in content:
+        review_dirs = []
+        if not os.path.isdir(base_dir):
+            return review_dirs
+        for basename in os.listdir(base_dir):
             review_path = os.path.join(base_dir, basename)
             if not (
                 os.path.isdir(review_path)
                 and (match := re.match(REVIEW_RE, basename))
             ):
                 continue
-            review_id = match.group(1)
-            review_cache = ReviewCache(id=review_id)
+            review_dirs.append((match.group(1), basename))
+        return review_dirs
+
+    def get_reviews(self) -> list[ReviewCache]:
+        reviews = []
+        index = self.get_review_index()
+        if index is not None:
+            for review_data in index.get_reviews_data():
+                review_cache = ReviewCache(review_data["id"], conf=self._conf)
+                review_cache.load_data(review_data)
+                reviews.append(review_cache)
+            return reviews
+        for review_id, _ in self._get_review_dirs():
+            review_cache = ReviewCache(id=review_id, conf=self._conf)
             review_cache.load_data()
             reviews.append(review_cache)
         return reviews
@@ -420,11 +835,15 @@ class ProjectCache(ItemCache):
         self,
         key: Union[
             Literal[
+                "needs_update",
                 "needs_data_sync",
                 "needs_media",
                 "needs_csv",
                 "needs_zip",
                 "needs_files",
+                "needs_csv_refresh",
+                "needs_zip_refresh",
+                "needs_files_refresh",
                 "is_complete",
             ],
             FunctionType,
@@ -442,7 +861,79 @@ class ProjectCache(ItemCache):
             func = _get_review_prop
         return list(filter(func, reviews))  # type: ignore
 
+    def filter_review_ids(
+        self,
+        key: Union[str, FunctionType],
+        reviews: Optional[list[ReviewCache]] = None,
+    ) -> list[str]:
+        index = self.get_review_index()
+        if index is not None and isinstance(key, str) and reviews is None:
+            return index.get_review_ids(key)
+        return [review._id for review in self.filter_reviews(key, reviews)]
+
+    def count_reviews(self, key: Optional[str] = None) -> int:
+        index = self.get_review_index()
+        if index is not None:
+            return index.count_reviews(key)
+        if key is None:
+            return len(self.get_reviews())
+        return len(self.filter_reviews(key))
+
+    def update_notes(self) -> int:
+        # returns the number of csv files parsed
+        return sum(
+            1
+            for review in self.filter_reviews(key=lambda r: not r.needs_csv)
+            if review.update_notes()
+        )
+
+    def verify_media(
+        self, workers: int = 4
+    ) -> list[tuple[ReviewItemCache, str]]:
+        # Hashes the cached media of every review item that has a checksum,
+        # workers files at a time, and returns the ones that do not match
+        item_caches = {}
+        for review in self.get_reviews():
+            for review_item_cache in review.get_review_item_caches():
+                checksum = review_item_cache.checksum
+                if checksum is not None:
+                    item_caches[review_item_cache.media_path] = (
+                        review_item_cache,
+                        checksum,
+                    )
+        mismatches = verify_files(
+            (
+                (path, checksum)
+                for path, (_, checksum) in item_caches.items()
+            ),
+            workers=workers,
+        )
+        # media ingested without its bytes being read only has its size
+        # recorded, its digest is taken once the size is known to match
+        mismatched = {path for path, _ in mismatches}
+        unhashed = [
+            path
+            for path, (_, checksum) in item_caches.items()
+            if checksum.get("digest") is None and path not in mismatched
+        ]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for path, checksum in zip(
+                unhashed, executor.map(Checksum.of_file, unhashed)
+            ):
+                item_caches[path][0].record_checksum(checksum)
+        return [(item_caches[path][0], reason) for path, reason in mismatches]
+
     def get_candidate_reviews(self, top: int = 5) -> list[ReviewCache]:
+        index = self.get_review_index()
+        if index is not None:
+            counts = index.get_file_counts("zip", key="is_complete")
+            if all(count is not None for _, count in counts):
+                reviews = []
+                for review_id, _ in counts[:top]:
+                    review_cache = ReviewCache(review_id, conf=self._conf)
+                    review_cache.load_data()
+                    reviews.append(review_cache)
+                return reviews
         reviews = self.filter_reviews(key="is_complete")
         reviews_ordered = sorted(
             reviews,
@@ -453,12 +944,48 @@ class ProjectCache(ItemCache):
 
 
 def print_analytics():
-    cache = ProjectCache()
+    cache = ProjectCache(get_project_id())
+    if cache.get_review_index() is not None:
+        print(cache.count_reviews())
+        for key in (
+            "needs_update",
+            "needs_data_sync",
+            "needs_media",
+            "needs_zip",
+            "needs_csv",
+            "needs_files",
+            "is_complete",
+        ):
+            print(cache.count_reviews(key))
+        return
     reviews = cache.get_reviews()
-    print(len(cache.get_reviews()))
+    print(len(reviews))
+    print(len(cache.filter_reviews(key="needs_update", reviews=reviews)))
     print(len(cache.filter_reviews(key="needs_data_sync", reviews=reviews)))
     print(len(cache.filter_reviews(key="needs_media", reviews=reviews)))
     print(len(cache.filter_reviews(key="needs_zip", reviews=reviews)))
     print(len(cache.filter_reviews(key="needs_csv", reviews=reviews)))
     print(len(cache.filter_reviews(key="needs_files", reviews=reviews)))
     print(len(cache.filter_reviews(key="is_complete", reviews=reviews)))
+
+
+def verify_cached_media(workers: int = 4):
+    mismatches = ProjectCache(get_project_id()).verify_media(workers)
+    for review_item_cache, reason in mismatches:
+        print(f"{review_item_cache.media_path}: {reason}")
+    print(f"{len(mismatches)} media files do not match their checksum")
+
+
+def rebuild_cache_index():
+    index = ProjectCache(get_project_id()).rebuild_index()
+    print(f"Rebuilt {index.count_reviews()} reviews into {index.path}")
+
+
+def update_notes_store():
+    cache = ProjectCache(get_project_id())
+    num_parsed = cache.update_notes()
+    store = cache.notes_store
+    print(
+        f"Parsed {num_parsed} csv files, {store.count_notes()} notes"
+        f" in {store.path}"
+    )
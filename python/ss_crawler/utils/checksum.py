@@ -0,0 +1,136 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional
+import hashlib
+import mmap
+
+
+ALGORITHM = "blake2b"
+# blake2b of the blake2b digests of the block_size blocks of a file
+TREE_ALGORITHM = "blake2b-tree"
+DIGEST_SIZE = 16
+# large slices keep hashing in C, where the GIL is released, so files are
+# hashed in parallel across threads
+HASH_SLICE_SIZE = 8 * 1024 * 1024
+
+
+def tree_digest(block_digests: Iterable[str]) -> str:
+    tree = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    for block_digest in block_digests:
+        tree.update(bytes.fromhex(block_digest))
+    return tree.hexdigest()
+
+
+class Checksum(object):
+    # Size and blake2b digest of a file, fed with its bytes while they are
+    # copied or transferred so that no separate read of the file is needed.
+    # Files fetched in ranges get the tree digest of the digests of their
+    # ranges instead, and files that reached the cache without their bytes
+    # being read, e.g. renamed or linked, only get their size until
+    # verify_files() is asked for their digest.
+    def __init__(self):
+        self._hash = hashlib.blake2b(digest_size=DIGEST_SIZE)
+        self.size = 0
+        self.block_size = None
+        self._digest = None
+
+    def update(self, chunk: bytes):
+        self._hash.update(chunk)
+        self.size += len(chunk)
+
+    def update_file(self, path: str):
+        with open(path, "rb") as _file:
+            try:
+                mapped = mmap.mmap(_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty files cannot be mapped
+                return
+            with mapped, memoryview(mapped) as view:
+                for offset in range(0, len(view), HASH_SLICE_SIZE):
+                    self.update(view[offset : offset + HASH_SLICE_SIZE])
+
+    def record_size(self, size: int):
+        self._hash = None
+        self.size = size
+
+    def record_blocks(
+        self, block_size: int, size: int, block_digests: Iterable[str]
+    ):
+        self._hash = None
+        self.size = size
+        self.block_size = block_size
+        self._digest = tree_digest(block_digests)
+
+    @property
+    def digest(self) -> Optional[str]:
+        if self._hash is not None:
+            return self._hash.hexdigest()
+        return self._digest
+
+    def to_dict(self) -> dict:
+        if self.block_size is not None:
+            return {
+                "algorithm": TREE_ALGORITHM,
+                "size": self.size,
+                "digest": self.digest,
+                "block_size": self.block_size,
+            }
+        return {
+            "algorithm": ALGORITHM,
+            "size": self.size,
+            "digest": self.digest,
+        }
+
+    @classmethod
+    def of_file(
+        cls, path: str, block_size: Optional[int] = None
+    ) -> "Checksum":
+        checksum = cls()
+        if block_size is None:
+            checksum.update_file(path)
+            return checksum
+        block_digests = []
+        with open(path, "rb") as _file:
+            while block := _file.read(block_size):
+                block_digests.append(
+                    hashlib.blake2b(block, digest_size=DIGEST_SIZE).hexdigest()
+                )
+                checksum.size += len(block)
+        checksum.record_blocks(block_size, checksum.size, block_digests)
+        return checksum
+
+
+def verify_file(path: str, expected: dict) -> Optional[str]:
+    # Returns why path does not match the expected checksum, if it doesn't.
+    # The size is compared first so truncated files are not hashed, and is
+    # all there is to compare when no digest was recorded.
+    algorithm = expected.get("algorithm", ALGORITHM)
+    if algorithm not in (ALGORITHM, TREE_ALGORITHM):
+        return f"unsupported algorithm {algorithm}"
+    try:
+        with open(path, "rb") as _file:
+            size = _file.seek(0, 2)
+    except OSError as exc:
+        return f"unreadable: {exc}"
+    if size != expected["size"]:
+        return f"size {size} != {expected['size']}"
+    if expected.get("digest") is None:
+        return None
+    digest = Checksum.of_file(path, expected.get("block_size")).digest
+    if digest != expected["digest"]:
+        return f"digest {digest} != {expected['digest']}"
+    return None
+
+
+def verify_files(
+    files: Iterable[tuple[str, dict]], workers: int = 4
+) -> list[tuple[str, str]]:
+    # files are (path, expected checksum) pairs, returns the (path, reason)
+    # pairs of the ones that do not match
+    files = list(files)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(lambda job: verify_file(*job), files)
+        return [
+            (path, reason)
+            for (path, _), reason in zip(files, results)
+            if reason is not None
+        ]
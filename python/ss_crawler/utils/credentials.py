@@ -1,17 +1,44 @@
-import json
+from typing import Any
 import os
 import re
 
-from ss_crawler import pages
+from ss_crawler.conf import ENV_PREFIX, apply_overrides, load_json
 from ss_crawler.exceptions import InvalidValue
 
 
-CRED_PATH = os.path.abspath(os.path.expanduser("~/.ss_crawler/credentials.json"))
+CRED_PATH = os.path.abspath(
+    os.path.expanduser(
+        os.environ.get(
+            f"{ENV_PREFIX}CREDENTIALS", "~/.ss_crawler/credentials.json"
+        )
+    )
+)
+CRED_KEYS = ("url", "email", "password")
+
+
+_credential_overrides = {}
+
+
+def set_credentials_override(key: str, value: Any):
+    _credential_overrides[key] = value
+
+
+def clear_credentials_overrides():
+    _credential_overrides.clear()
 
 
 def get_credentials(path=CRED_PATH):
-    with open(path) as _cred:
-        return json.load(_cred)
+    # Credentials can come entirely from the environment or overrides, in
+    # which case the credentials file does not need to exist
+    try:
+        data = load_json(path)
+    except FileNotFoundError:
+        data = {key: None for key in CRED_KEYS}
+        credentials = apply_overrides(data, _credential_overrides, CRED_KEYS)
+        if any(credentials[key] is None for key in CRED_KEYS):
+            raise
+        return credentials
+    return apply_overrides(data, _credential_overrides, CRED_KEYS)
 
 
 def get_url(path=CRED_PATH):
@@ -27,6 +54,9 @@ def get_password(path=CRED_PATH):
 
 
 def get_project_id(path=CRED_PATH):
+    # imported here as pages itself needs the credentials
+    from ss_crawler import pages
+
     url = get_url(path)
     if match := re.match(pages.ProjectPage.url_re, url):
         return match.group(2)
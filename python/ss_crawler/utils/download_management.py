@@ -1,13 +1,46 @@
+import collections
+import ctypes
+import ctypes.util
+import errno
 import os
+import re
+import select
 import shutil
+import struct
+import sys
+import threading
 import time
+import traceback
 import fnmatch
 
-from typing import Optional, Union
+from concurrent.futures import Future
+from queue import Queue
+from typing import Any, Callable, Optional, Union
 
 from .filesize import FileSize
+from .transfer import PendingTransfer
 from ..conf import get_download_location
-from ..exceptions import DownloadTimeout, DownloadNotDetected
+from ..exceptions import (
+    DownloadException,
+    DownloadTimeout,
+    DownloadNotDetected,
+)
+
+
+# characters Chrome replaces with "_" in the names of downloaded files
+UNSAFE_NAME_CHARS = re.compile(r'[<>:"/\\|?*\x00-\x1f]')
+
+
+def is_download_of(file_name: str, expected: str) -> bool:
+    # file_name is expected as Chrome saves it, or its "name (n).ext" copy
+    # when a file of that name is in the download directory already
+    stem, ext = os.path.splitext(UNSAFE_NAME_CHARS.sub("_", expected))
+    return (
+        re.fullmatch(
+            rf"{re.escape(stem)}(?: \(\d+\))?{re.escape(ext)}", file_name
+        )
+        is not None
+    )
 
 
 def remove_dir_contents(dirname: str) -> bool:
@@ -27,6 +60,200 @@ def remove_dir_contents(dirname: str) -> bool:
     return False
 
 
+class PollingWatcher(object):
+    # Reports the contents of a directory by listing it, waiting a fixed
+    # time between listings
+    def __init__(self, path: str):
+        self.path = path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def contents(self) -> set:
+        return set(os.listdir(self.path))
+
+    def wait(self, timeout: float) -> bool:
+        time.sleep(timeout)
+        return False
+
+    def close(self):
+        pass
+
+
+class InotifyDirectory(object):
+    # One inotify instance per watched directory, shared by every watcher
+    # of it since the instances a user may open are few (128 by default).
+    # The contents are kept up to date from the events, which one thread at
+    # a time waits for while the others wait on the condition.
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = 0o2000000
+    ADDED = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    REMOVED = IN_MOVED_FROM | IN_DELETE
+    EVENT = struct.Struct("iIII")
+
+    _libc = None
+    _directories: dict[str, "InotifyDirectory"] = {}
+    _directories_lock = threading.Lock()
+
+    def __init__(self, path: str):
+        self.path = path
+        self.users = 0
+        libc = self.get_libc()
+        self._fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self._fd < 0:
+            _errno = ctypes.get_errno()
+            raise OSError(_errno, os.strerror(_errno))
+        watch = libc.inotify_add_watch(
+            self._fd, os.fsencode(path), self.ADDED | self.REMOVED
+        )
+        if watch < 0:
+            _errno = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(_errno, os.strerror(_errno), path)
+        self._contents = set(os.listdir(path))
+        self._condition = threading.Condition()
+        self._generation = 0
+        self._selecting = False
+
+    @classmethod
+    def get_libc(cls):
+        if cls._libc is None:
+            if not sys.platform.startswith("linux"):
+                raise OSError(errno.ENOSYS, "inotify is only on linux")
+            libc = ctypes.CDLL(
+                ctypes.util.find_library("c") or "libc.so.6", use_errno=True
+            )
+            if not hasattr(libc, "inotify_init1"):
+                raise OSError(errno.ENOSYS, "libc has no inotify support")
+            cls._libc = libc
+        return cls._libc
+
+    @classmethod
+    def acquire(cls, path: str) -> "InotifyDirectory":
+        path = os.path.abspath(path)
+        with cls._directories_lock:
+            directory = cls._directories.get(path)
+            if directory is None:
+                directory = cls._directories[path] = cls(path)
+            directory.users += 1
+            return directory
+
+    def release(self):
+        with self._directories_lock:
+            self.users -= 1
+            if self.users > 0:
+                return
+            del self._directories[self.path]
+        with self._condition:
+            os.close(self._fd)
+            self._fd = -1
+
+    def contents(self) -> set:
+        with self._condition:
+            self._read_events()
+            return set(self._contents)
+
+    def wait(self, timeout: float) -> bool:
+        # returns once the contents changed, False after timeout
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            generation = self._generation
+            while self._generation == generation:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                if self._selecting:
+                    self._condition.wait(remaining)
+                    continue
+                self._selecting = True
+                self._condition.release()
+                try:
+                    readable, _, _ = select.select(
+                        [self._fd], [], [], remaining
+                    )
+                finally:
+                    self._condition.acquire()
+                    self._selecting = False
+                if readable:
+                    self._read_events()
+                self._condition.notify_all()
+            return True
+
+    def _read_events(self):
+        # called with the condition held
+        while self._fd >= 0:
+            try:
+                buffer = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(buffer):
+                _, mask, _, length = self.EVENT.unpack_from(buffer, offset)
+                offset += self.EVENT.size
+                name = os.fsdecode(
+                    buffer[offset:offset + length].rstrip(b"\0")
+                )
+                offset += length
+                if mask & self.IN_Q_OVERFLOW:
+                    self._contents = set(os.listdir(self.path))
+                elif mask & self.ADDED:
+                    self._contents.add(name)
+                elif mask & self.REMOVED:
+                    self._contents.discard(name)
+            self._generation += 1
+            self._condition.notify_all()
+
+
+class InotifyWatcher(PollingWatcher):
+    # Keeps the contents of a directory up to date from Linux inotify
+    # events, so that wait() returns as soon as a file is created, finished
+    # or renamed (e.g. from .crdownload to its final name)
+    def __init__(self, path: str):
+        super().__init__(path)
+        self._directory: Optional[InotifyDirectory] = (
+            InotifyDirectory.acquire(path)
+        )
+
+    def contents(self) -> set:
+        if self._directory is None:
+            return super().contents()
+        return self._directory.contents()
+
+    def wait(self, timeout: float) -> bool:
+        if self._directory is None:
+            return super().wait(timeout)
+        return self._directory.wait(timeout)
+
+    def close(self):
+        if self._directory is not None:
+            self._directory.release()
+            self._directory = None
+
+
+_inotify_failed = threading.Event()
+
+
+def create_watcher(path: str, use_inotify: bool = True) -> PollingWatcher:
+    # falls back to polling when inotify is unavailable or out of instances
+    if use_inotify:
+        try:
+            return InotifyWatcher(path)
+        except OSError as exc:
+            if not _inotify_failed.is_set():
+                _inotify_failed.set()
+                print(f"inotify unavailable ({exc}), polling {path}")
+    return PollingWatcher(path)
+
+
 def discover_downloaded_file(
     file_pattern: str,
     file_size: Optional[FileSize] = None,
@@ -35,14 +262,22 @@ def discover_downloaded_file(
     wait: float = 0,
     sleep: float = 1,
     partial_wait: float = 10,
+    accept: Optional[Callable[[str], bool]] = None,
+    watcher: Optional[PollingWatcher] = None,
+    file_name: Optional[str] = None,
 ) -> Union[str, None]:
+    # file_name is the name the download is expected to be saved under,
+    # files only matching file_pattern are not taken for it
     print("waiting for download", file_pattern)
 
     if download_location is None:
         download_location = get_download_location()
 
+    if watcher is None:
+        watcher = PollingWatcher(download_location)
+
     if old_contents is None:
-        old_contents = set(os.listdir(download_location))
+        old_contents = watcher.contents()
 
     match_found = False
     file_found = None
@@ -54,7 +289,7 @@ def discover_downloaded_file(
         partial_wait = 1
 
     while not match_found:
-        new_contents = set(os.listdir(download_location))
+        new_contents = watcher.contents()
         diff = new_contents - old_contents
 
         elapsed = time.perf_counter() - start
@@ -66,18 +301,32 @@ def discover_downloaded_file(
                 download_started = True
 
             if fnmatch.fnmatchcase(_file, file_pattern):
+                if file_name is not None and not is_download_of(
+                    _file, file_name
+                ):
+                    continue
+                if accept is not None and not accept(
+                    os.path.join(download_location, _file)
+                ):
+                    continue
                 match_found = True
                 file_found = _file
+                break
 
         if partial_files_found and file_size is not None:
             partial_file = partial_files_found[0]
-            size = FileSize(os.path.getsize(
-                os.path.join(download_location, partial_file)
-            ))
-            print((
-                f"{size.value/file_size.value * 100:.02f}% downloaded! - "
-                f"({size.humanized()} of {file_size.humanized()})"
-            ))
+            try:
+                size = FileSize(os.path.getsize(
+                    os.path.join(download_location, partial_file)
+                ))
+            except OSError:
+                # renamed to its final name since it was listed
+                size = None
+            if size is not None:
+                print((
+                    f"{size.value/file_size.value * 100:.02f}% downloaded! - "
+                    f"({size.humanized()} of {file_size.humanized()})"
+                ))
         if not partial_files_found:
             if download_started:
                 download_started = False
@@ -91,12 +340,218 @@ def discover_downloaded_file(
             if elapsed > wait:
                 raise DownloadTimeout(f"Download timeout: {wait}s")
 
-        time.sleep(sleep)
+        if not match_found:
+            watcher.wait(sleep)
 
     if file_found is not None:
         return os.path.join(download_location, file_found)
 
 
+def wait_for_download_start(
+    file_pattern: str,
+    download_location: str,
+    old_contents: set,
+    sleep: float = 0.2,
+    partial_wait: float = 10,
+    watcher: Optional[PollingWatcher] = None,
+) -> str:
+    # Returns the name of the first new partial or matching file
+    if watcher is None:
+        watcher = PollingWatcher(download_location)
+    start = time.perf_counter()
+    while True:
+        diff = watcher.contents() - old_contents
+        for _file in diff:
+            if fnmatch.fnmatch(_file, "*.crdownload") or (
+                fnmatch.fnmatchcase(_file, file_pattern)
+            ):
+                return _file
+        elapsed = time.perf_counter() - start
+        if elapsed > partial_wait:
+            raise DownloadNotDetected(f"{elapsed}s but no download started")
+        watcher.wait(sleep)
+
+
+class PendingDownload(object):
+    # A download that was started by the browser but is not complete yet,
+    # with what is needed to recognise the file once it is
+    def __init__(
+        self,
+        pattern: str,
+        download_location: str,
+        old_contents: set,
+        file_size: Optional[FileSize] = None,
+        wait: float = 0,
+        sleep: float = 1,
+        watcher: Optional[PollingWatcher] = None,
+        file_name: Optional[str] = None,
+    ):
+        self.pattern = pattern
+        self.download_location = download_location
+        self.old_contents = old_contents
+        self.file_size = file_size
+        self.wait = wait
+        self.sleep = sleep
+        self.watcher = watcher
+        self.file_name = file_name
+
+    def close(self):
+        if self.watcher is not None:
+            self.watcher.close()
+
+    def __repr__(self):
+        return (
+            f"PendingDownload({self.pattern!r}, "
+            f"{self.download_location!r}, file_size={self.file_size!r},"
+            f" file_name={self.file_name!r})"
+        )
+
+
+class DownloadPipeline(object):
+    # Completes PendingDownloads in background threads so that the browser
+    # can carry on while files are transferred. on_complete is called with
+    # the path of the verified download, typically to move it to the cache.
+    def __init__(self, threads: int = 1):
+        self.threads = threads
+        self.completed = []
+        self.errors = []
+        self._queue = Queue()
+        self._claimed = set()
+        self._lock = threading.Lock()
+        self._workers = []
+        # browser downloads in the pipeline per download location, which the
+        # browser writing them must not be restarted under
+        self._browser_downloads = collections.Counter()
+        self._browser_downloads_changed = threading.Condition()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.join()
+
+    def start(self):
+        for index in range(self.threads):
+            worker = threading.Thread(
+                target=self._run, name=f"download_pipeline_{index}"
+            )
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(
+        self,
+        pending: Union[PendingDownload, PendingTransfer],
+        on_complete: Callable[[str], Any],
+    ) -> Future:
+        # the future resolves to what on_complete returned, or the error the
+        # download failed with
+        future = Future()
+        if isinstance(pending, PendingDownload):
+            with self._browser_downloads_changed:
+                self._browser_downloads[pending.download_location] += 1
+        self._queue.put((pending, on_complete, future))
+        return future
+
+    def drain(self, download_location: Optional[str] = None):
+        # Waits until the browser downloads into download_location, or all
+        # of them, left the pipeline, e.g. before restarting the browser
+        def _drained() -> bool:
+            if download_location is None:
+                return not any(self._browser_downloads.values())
+            return not self._browser_downloads[download_location]
+
+        with self._browser_downloads_changed:
+            if not _drained():
+                print("Waiting for the browser downloads to complete ...")
+            self._browser_downloads_changed.wait_for(_drained)
+
+    def join(self):
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        if self.errors:
+            print(f"{len(self.errors)} downloads failed in the pipeline")
+
+    def _claim(self, pending: PendingDownload, path: str) -> bool:
+        # With a file name the download was already recognised by it and
+        # its size is only a sanity check, otherwise the size is all that
+        # tells apart downloads of the same pattern. Claims are keyed on the
+        # file rather than its path, which a later download may reuse once
+        # the file was moved out.
+        with self._lock:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return False
+            key = (path, stat.st_ino, stat.st_mtime_ns)
+            if key in self._claimed:
+                return False
+            size = stat.st_size
+            file_size = pending.file_size
+            if file_size is not None and not file_size.matches(size):
+                if pending.file_name is not None:
+                    raise DownloadException(
+                        f"{path} is {size} bytes, expected {file_size}"
+                    )
+                return False
+            self._claimed.add(key)
+            return True
+
+    def _release(self, path: str):
+        # the file was ingested, its path is free for other downloads
+        with self._lock:
+            self._claimed = {key for key in self._claimed if key[0] != path}
+
+    def _complete(
+        self, pending: Union[PendingDownload, PendingTransfer]
+    ) -> str:
+        if isinstance(pending, PendingTransfer):
+            # fetched over http rather than watched for in the downloads
+            return pending.run()
+        path = discover_downloaded_file(
+            pending.pattern,
+            file_size=pending.file_size,
+            download_location=pending.download_location,
+            old_contents=pending.old_contents,
+            wait=pending.wait,
+            sleep=pending.sleep,
+            accept=lambda path: self._claim(pending, path),
+            watcher=pending.watcher,
+            file_name=pending.file_name,
+        )
+        if path is None:
+            raise DownloadException(f"No file completed for {pending}")
+        return path
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            pending, on_complete, future = job
+            try:
+                path = self._complete(pending)
+                result = on_complete(path)
+                self.completed.append(result)
+                self._release(path)
+            except Exception as exc:
+                traceback.print_exc()
+                self.errors.append((pending, exc))
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+            finally:
+                pending.close()
+                if isinstance(pending, PendingDownload):
+                    with self._browser_downloads_changed:
+                        self._browser_downloads[pending.download_location] -= 1
+                        self._browser_downloads_changed.notify_all()
+
+
 class DownloadManager(object):
     def __init__(
         self,
@@ -106,6 +561,9 @@ class DownloadManager(object):
         wait: int = 0,
         sleep: float = 1,
         make_empty: bool = False,
+        detach: bool = False,
+        use_inotify: bool = True,
+        file_name: Optional[str] = None,
     ):
         if download_location is None:
             download_location = get_download_location()
@@ -116,21 +574,60 @@ class DownloadManager(object):
         self.sleep = sleep
         self.make_empty = make_empty
         self.file_size = file_size
+        # When detached, leaving the context only waits for the download to
+        # start and exposes it as self.pending for a DownloadPipeline
+        self.detach = detach
+        self.pending = None
+        self.downloaded_file = None
+        self.use_inotify = use_inotify
+        self.watcher = None
+        self.file_name = file_name
 
     def __enter__(self):
         if self.make_empty:
             remove_dir_contents(self.download_location)
         if not os.path.exists(self.download_location):
             os.makedirs(self.download_location)
-        self.old_contents = set(os.listdir(self.download_location))
+        # The watcher has to exist before the download is triggered so that
+        # none of its events are missed
+        self.watcher = create_watcher(self.download_location, self.use_inotify)
+        self.old_contents = self.watcher.contents()
         return self
 
     def __exit__(self, *_):
-        self.downloaded_file = discover_downloaded_file(
-            self.pattern,
-            file_size=self.file_size,
-            download_location=self.download_location,
-            old_contents=self.old_contents,
-            wait=self.wait,
-            sleep=self.sleep,
-        )
+        if self.detach:
+            try:
+                wait_for_download_start(
+                    self.pattern,
+                    self.download_location,
+                    self.old_contents,
+                    watcher=self.watcher,
+                )
+            except BaseException:
+                self.watcher.close()
+                raise
+            # the pending download takes over the watcher
+            self.pending = PendingDownload(
+                self.pattern,
+                self.download_location,
+                self.old_contents,
+                file_size=self.file_size,
+                wait=self.wait,
+                sleep=self.sleep,
+                watcher=self.watcher,
+                file_name=self.file_name,
+            )
+            return
+        try:
+            self.downloaded_file = discover_downloaded_file(
+                self.pattern,
+                file_size=self.file_size,
+                download_location=self.download_location,
+                old_contents=self.old_contents,
+                wait=self.wait,
+                sleep=self.sleep,
+                watcher=self.watcher,
+                file_name=self.file_name,
+            )
+        finally:
+            self.watcher.close()
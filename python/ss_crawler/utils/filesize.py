@@ -40,6 +40,15 @@ class FileSize:
     def is_valid(self) -> bool:
         return self.value >= 0
 
+    def matches(
+        self, other: Union["FileSize", int, str], tolerance: float = 0.1
+    ) -> bool:
+        # Sizes shown on the site are rounded and may use binary units, so
+        # they can only be compared within a relative tolerance
+        other_value = self.__value__(other)
+        largest = max(abs(self.value), abs(other_value))
+        return abs(self.value - other_value) <= largest * tolerance
+
     @classmethod
     def unit_value(cls, unit: str):
         index = cls.UNITS.index(unit)
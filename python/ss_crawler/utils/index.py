@@ -0,0 +1,453 @@
+from contextlib import contextmanager
+from typing import Iterator, Optional
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+INDEX_FILENAME = "cache_index.sqlite3"
+SCHEMA_VERSION = 5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS projects (
+    id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS reviews (
+    id TEXT PRIMARY KEY,
+    project_id TEXT,
+    name TEXT,
+    item_count INTEGER,
+    num_review_items INTEGER NOT NULL DEFAULT 0,
+    fingerprint TEXT,
+    synced_fingerprint TEXT,
+    notes_total INTEGER,
+    notes_key TEXT,
+    data TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS review_files (
+    review_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER,
+    mtime REAL,
+    count INTEGER,
+    notes_key TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (review_id, kind)
+);
+CREATE TABLE IF NOT EXISTS review_items (
+    id TEXT NOT NULL,
+    review_id TEXT NOT NULL,
+    name TEXT,
+    size INTEGER,
+    upload_time REAL,
+    media_size INTEGER,
+    media_mtime REAL,
+    checksum_size INTEGER,
+    data TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (review_id, id)
+);
+CREATE INDEX IF NOT EXISTS reviews_project ON reviews (project_id);
+"""
+
+# keys of the counts recorded in the review metadata for each file kind
+FILE_COUNT_KEYS = {"csv": "num_notes", "zip": "num_sketches"}
+
+TABLES = ("projects", "reviews", "review_files", "review_items")
+
+NEEDS_MEDIA = """
+EXISTS (
+    SELECT 1 FROM review_items AS ri
+    WHERE ri.review_id = reviews.id
+    AND (
+        COALESCE(ri.media_mtime, 0) < COALESCE(ri.upload_time, 0)
+        OR ri.media_size != ri.checksum_size
+    )
+)
+"""
+NEEDS_UPDATE = "(reviews.synced_fingerprint IS NOT reviews.fingerprint)"
+NEEDS_DATA_SYNC = (
+    "(reviews.item_count IS NULL"
+    " OR reviews.item_count != reviews.num_review_items"
+    f" OR {NEEDS_UPDATE})"
+)
+NEEDS_CSV = (
+    "NOT EXISTS (SELECT 1 FROM review_files AS rf"
+    " WHERE rf.review_id = reviews.id AND rf.kind = 'csv')"
+)
+NEEDS_ZIP = (
+    "NOT EXISTS (SELECT 1 FROM review_files AS rf"
+    " WHERE rf.review_id = reviews.id AND rf.kind = 'zip')"
+)
+NEEDS_FILES = f"({NEEDS_CSV} OR {NEEDS_ZIP})"
+# an export is stale when the notes of the review items changed since it
+# was stored, csv files stored without a notes key compare their count
+STALE_FILE = """
+EXISTS (
+    SELECT 1 FROM review_files AS rf
+    WHERE rf.review_id = reviews.id AND rf.kind = '{kind}'
+    AND CASE
+        WHEN rf.notes_key IS NOT NULL THEN rf.notes_key != reviews.notes_key
+        WHEN rf.kind = 'csv' AND rf.count IS NOT NULL
+            THEN rf.count != reviews.notes_total
+        ELSE 0
+    END
+)
+"""
+NEEDS_CSV_REFRESH = f"({NEEDS_CSV} OR {STALE_FILE.format(kind='csv')})"
+NEEDS_ZIP_REFRESH = f"({NEEDS_ZIP} OR {STALE_FILE.format(kind='zip')})"
+NEEDS_FILES_REFRESH = f"({NEEDS_CSV_REFRESH} OR {NEEDS_ZIP_REFRESH})"
+
+# sql conditions matching the ReviewCache property of the same name
+REVIEW_FILTERS = {
+    "needs_update": NEEDS_UPDATE,
+    "needs_data_sync": NEEDS_DATA_SYNC,
+    "needs_media": NEEDS_MEDIA,
+    "needs_csv": NEEDS_CSV,
+    "needs_zip": NEEDS_ZIP,
+    "needs_files": NEEDS_FILES,
+    "needs_csv_refresh": NEEDS_CSV_REFRESH,
+    "needs_zip_refresh": NEEDS_ZIP_REFRESH,
+    "needs_files_refresh": NEEDS_FILES_REFRESH,
+    "is_complete": (
+        f"NOT ({NEEDS_DATA_SYNC} OR {NEEDS_FILES} OR {NEEDS_MEDIA})"
+    ),
+}
+
+
+_indexes = {}
+
+
+def get_cache_index(cache_base_dir: str) -> "CacheIndex":
+    if cache_base_dir not in _indexes:
+        _indexes[cache_base_dir] = CacheIndex(cache_base_dir)
+    return _indexes[cache_base_dir]
+
+
+def notes_signature(review_items: list[dict]) -> tuple[int, str]:
+    # total notes of the review items and a key of the notes per item
+    notes = sorted(
+        (item["id"], item.get("notes") or 0) for item in review_items
+    )
+    key = hashlib.blake2b(
+        json.dumps(notes).encode(), digest_size=16
+    ).hexdigest()
+    return sum(count for _, count in notes), key
+
+
+def file_stat(path: str) -> tuple[Optional[int], Optional[float]]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None, None
+    return stat.st_size, stat.st_mtime
+
+
+def load_checksum(item_dir: str) -> Optional[dict]:
+    # the checksum recorded in the metadata of a review item, if any
+    metadata_path = os.path.join(item_dir, "review_item_metadata.json")
+    try:
+        with open(metadata_path) as datafile:
+            return json.load(datafile).get("checksum")
+    except (OSError, ValueError):
+        return None
+
+
+class CacheIndex(object):
+    # SQLite index of the cache metadata kept next to the json files, so
+    # that the state of every review can be queried without walking the
+    # cache tree. The json files stay the source of truth: the index can
+    # always be rebuilt from them.
+    def __init__(self, cache_base_dir: str):
+        self.cache_base_dir = cache_base_dir
+        self.path = os.path.join(cache_base_dir, INDEX_FILENAME)
+        self._initialized = False
+
+    @contextmanager
+    def connect(self) -> Iterator[sqlite3.Connection]:
+        # one connection per transaction so that the index can be used from
+        # the sync worker threads
+        if not os.path.exists(self.cache_base_dir):
+            os.makedirs(self.cache_base_dir)
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            if not self._initialized:
+                self._initialize(conn)
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _initialize(self, conn: sqlite3.Connection):
+        # The cache root is usually a network share, where the shared
+        # memory of WAL is unsafe. The rollback journal is set explicitly as
+        # WAL persists in databases made by earlier versions.
+        conn.execute("PRAGMA journal_mode=DELETE")
+        with conn:
+            conn.executescript(SCHEMA)
+            row = conn.execute(
+                "SELECT value FROM meta WHERE key = 'schema_version'"
+            ).fetchone()
+            if row is None or int(row[0]) != SCHEMA_VERSION:
+                for table in TABLES:
+                    conn.execute(f"DROP TABLE IF EXISTS {table}")
+                conn.execute("DELETE FROM meta")
+                conn.executescript(SCHEMA)
+                conn.execute(
+                    "INSERT INTO meta VALUES ('schema_version', ?)",
+                    (str(SCHEMA_VERSION),),
+                )
+        self._initialized = True
+
+    def is_built(self) -> bool:
+        with self.connect() as conn:
+            row = conn.execute(
+                "SELECT value FROM meta WHERE key = 'built'"
+            ).fetchone()
+        return row is not None
+
+    def store_project(self, data: dict):
+        data = {k: v for k, v in data.items() if k != "reviews"}
+        with self.connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO projects VALUES (?, ?, ?)",
+                (data["id"], json.dumps(data), time.time()),
+            )
+
+    def store_review(
+        self, data: dict, conn: Optional[sqlite3.Connection] = None
+    ):
+        # data is the serialized review metadata including its review_items
+        if conn is None:
+            with self.connect() as conn:
+                return self.store_review(data, conn)
+        review_items = data.get("review_items", [])
+        notes_total, notes_key = notes_signature(review_items)
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO reviews"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                data["id"],
+                data.get("project_id"),
+                data.get("name"),
+                data.get("item_count"),
+                len(review_items),
+                data.get("fingerprint"),
+                data.get("synced_fingerprint"),
+                notes_total,
+                notes_key,
+                json.dumps(data),
+                now,
+            ),
+        )
+        ids = [item["id"] for item in review_items]
+        conn.execute(
+            "DELETE FROM review_items WHERE review_id = ?"
+            f" AND id NOT IN ({', '.join('?' * len(ids))})",
+            (data["id"], *ids),
+        )
+        for item in review_items:
+            self._upsert_review_item(conn, data["id"], item, now)
+
+    def _upsert_review_item(
+        self,
+        conn: sqlite3.Connection,
+        review_id: str,
+        data: dict,
+        now: float,
+        media: Optional[tuple[Optional[int], Optional[float]]] = None,
+    ):
+        # media is the (size, mtime) of the media file, when None the
+        # indexed media state is left as it is. The size of its checksum,
+        # recorded when it was stored, tells truncated media apart.
+        conn.execute(
+            """
+            INSERT INTO review_items
+            VALUES (?, ?, ?, ?, ?, NULL, NULL, NULL, ?, ?)
+            ON CONFLICT (review_id, id) DO UPDATE SET
+                name = excluded.name,
+                size = excluded.size,
+                upload_time = excluded.upload_time,
+                data = excluded.data,
+                updated = excluded.updated
+            """,
+            (
+                data["id"],
+                review_id,
+                data.get("name"),
+                data.get("size"),
+                data.get("upload_time"),
+                json.dumps(data),
+                now,
+            ),
+        )
+        if media is not None:
+            checksum_size = data.get("checksum_size")
+            if "checksum" in data:
+                checksum_size = (data["checksum"] or {}).get("size")
+            conn.execute(
+                "UPDATE review_items"
+                " SET media_size = ?, media_mtime = ?, checksum_size = ?"
+                " WHERE review_id = ? AND id = ?",
+                (*media, checksum_size, review_id, data["id"]),
+            )
+
+    def store_review_item(self, data: dict, media_path: str):
+        media = file_stat(media_path)
+        with self.connect() as conn:
+            self._upsert_review_item(
+                conn, data["review_id"], data, time.time(), media
+            )
+
+    def store_review_file(
+        self,
+        review_id: str,
+        kind: str,
+        path: str,
+        count: Optional[int] = None,
+        notes_key: Optional[str] = None,
+    ):
+        # count is the number of notes of a csv or sketches of a zip,
+        # notes_key the notes signature of the review items it was stored at
+        size, mtime = file_stat(path)
+        with self.connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO review_files"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    review_id,
+                    kind,
+                    path,
+                    size,
+                    mtime,
+                    count,
+                    notes_key,
+                    time.time(),
+                ),
+            )
+
+    def remove_review(self, review_id: str):
+        with self.connect() as conn:
+            conn.execute("DELETE FROM reviews WHERE id = ?", (review_id,))
+            for table in ("review_files", "review_items"):
+                conn.execute(
+                    f"DELETE FROM {table} WHERE review_id = ?", (review_id,)
+                )
+
+    def get_reviews_data(self) -> list[dict]:
+        with self.connect() as conn:
+            rows = conn.execute("SELECT data FROM reviews ORDER BY id")
+            return [json.loads(data) for data, in rows]
+
+    def get_review_ids(self, key: str) -> list[str]:
+        condition = REVIEW_FILTERS[key]
+        with self.connect() as conn:
+            rows = conn.execute(
+                f"SELECT id FROM reviews WHERE {condition} ORDER BY id"
+            )
+            return [review_id for review_id, in rows]
+
+    def count_reviews(self, key: Optional[str] = None) -> int:
+        condition = REVIEW_FILTERS[key] if key is not None else "1"
+        with self.connect() as conn:
+            row = conn.execute(
+                f"SELECT COUNT(*) FROM reviews WHERE {condition}"
+            ).fetchone()
+        return row[0]
+
+    def get_file_counts(
+        self, kind: str, key: Optional[str] = None
+    ) -> list[tuple[str, Optional[int]]]:
+        # (review_id, count) of the reviews matching key, largest first
+        condition = REVIEW_FILTERS[key] if key is not None else "1"
+        with self.connect() as conn:
+            rows = conn.execute(
+                "SELECT reviews.id, rf.count FROM reviews"
+                " LEFT JOIN review_files AS rf"
+                " ON rf.review_id = reviews.id AND rf.kind = ?"
+                f" WHERE {condition}"
+                " ORDER BY rf.count DESC, reviews.id",
+                (kind,),
+            )
+            return rows.fetchall()
+
+    def rebuild(self, review_dirs: list[tuple[str, str]]):
+        # review_dirs are (review_id, cache_dir) pairs found in the cache
+        with self.connect() as conn:
+            for table in TABLES:
+                conn.execute(f"DELETE FROM {table}")
+            conn.execute("DELETE FROM meta WHERE key = 'built'")
+            now = time.time()
+            for review_id, cache_dir in review_dirs:
+                self._rebuild_review(conn, review_id, cache_dir, now)
+            conn.execute("INSERT INTO meta VALUES ('built', ?)", (now,))
+
+    def _rebuild_review(
+        self,
+        conn: sqlite3.Connection,
+        review_id: str,
+        cache_dir: str,
+        now: float,
+    ):
+        metadata_path = os.path.join(cache_dir, "review_metadata.json")
+        data = {"id": review_id}
+        if os.path.exists(metadata_path):
+            with open(metadata_path) as datafile:
+                data = json.load(datafile)
+        self.store_review(data, conn)
+        files = {}
+        for entry in os.scandir(cache_dir):
+            if not entry.is_file():
+                continue
+            ext = os.path.splitext(entry.name)[1]
+            if ext in (".csv", ".zip") and ext[1:] not in files:
+                files[ext[1:]] = entry
+        records = data.get("files", {})
+        for kind, entry in files.items():
+            stat = entry.stat()
+            # counts recorded in the metadata are only kept while the file
+            # they were taken from is unchanged
+            record = records.get(kind, {})
+            count, notes_key = None, None
+            if (
+                record.get("name") == entry.name
+                and record.get("size") == stat.st_size
+                and record.get("mtime") == stat.st_mtime
+            ):
+                count = record.get(FILE_COUNT_KEYS[kind])
+                notes_key = record.get("notes_key")
+            conn.execute(
+                "INSERT OR REPLACE INTO review_files"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    review_id,
+                    kind,
+                    entry.path,
+                    stat.st_size,
+                    stat.st_mtime,
+                    count,
+                    notes_key,
+                    now,
+                ),
+            )
+        for item in data.get("review_items", []):
+            media = (None, None)
+            item_dir = os.path.join(cache_dir, f"item_{item['id']}")
+            if item.get("name"):
+                media = file_stat(os.path.join(item_dir, item["name"]))
+            if media[0] is not None and "checksum_size" not in item:
+                # recorded in the review items since, older caches only
+                # have it in the metadata of the item
+                item = {**item, "checksum": load_checksum(item_dir)}
+            self._upsert_review_item(conn, review_id, item, now, media)
@@ -0,0 +1,92 @@
+from typing import Optional
+import errno
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+from ..exceptions import CacheException
+from .checksum import Checksum
+
+
+INGEST_MODES = ("copy", "link", "move")
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# ioctl request to clone a file's extents (btrfs, xfs, ...) on linux
+FICLONE = 0x40049409
+
+
+def reflink(src: str, dst: str):
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, "reflink is not supported")
+    with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        except OSError:
+            dst_file.close()
+            os.unlink(dst)
+            raise
+    shutil.copystat(src, dst)
+
+
+def hardlink(src: str, dst: str):
+    os.link(src, dst)
+
+
+def stream_copy(
+    src: str,
+    dst: str,
+    buffer_size: int = COPY_BUFFER_SIZE,
+    checksum: Optional[Checksum] = None,
+):
+    with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+        while chunk := src_file.read(buffer_size):
+            dst_file.write(chunk)
+            if checksum is not None:
+                checksum.update(chunk)
+    shutil.copystat(src, dst)
+
+
+def ingest_file(
+    src: str,
+    dst: str,
+    mode: str = "copy",
+    checksum: Optional[Checksum] = None,
+) -> str:
+    # Brings src into the cache at dst and returns the method used.
+    #   copy: always a streaming copy, src is kept
+    #   link: reflink, then hardlink, then copy, src is kept
+    #   move: rename, then reflink or hardlink, then copy, src is removed
+    # checksum is fed with the bytes as they are copied, a renamed or
+    # linked dst is not read for it and only gets its size recorded
+    if mode not in INGEST_MODES:
+        raise CacheException(f"Unknown ingest mode: {mode}")
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    if mode == "move":
+        try:
+            os.rename(src, dst)
+            if checksum is not None:
+                checksum.record_size(os.path.getsize(dst))
+            return "rename"
+        except OSError as exc:
+            if exc.errno != errno.EXDEV:
+                raise
+    if mode in ("link", "move"):
+        for method in (reflink, hardlink):
+            try:
+                method(src, dst)
+            except OSError:
+                continue
+            if mode == "move":
+                os.unlink(src)
+            if checksum is not None:
+                checksum.record_size(os.path.getsize(dst))
+            return method.__name__
+    stream_copy(src, dst, checksum=checksum)
+    if mode == "move":
+        os.unlink(src)
+    return "copy"
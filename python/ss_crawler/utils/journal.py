@@ -0,0 +1,229 @@
+from typing import Iterable, Optional
+import json
+import os
+import threading
+import time
+
+from ..conf import DEFAULT_CONF_PATH, get_cache_location
+
+
+STAGES = ("data", "files", "media")
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# jobs failing this many times, over any number of runs, are given up on so
+# that a review that can no longer sync does not hold the journal open
+MAX_ATTEMPTS = 6
+
+
+def open_journal(
+    name: str, resume: bool = True, conf=DEFAULT_CONF_PATH
+) -> "SyncJournal":
+    # without resume any journal left by an earlier run is discarded
+    journal = SyncJournal(name, conf)
+    if resume:
+        return journal.load()
+    journal.finish()
+    return journal
+
+
+class SyncJournal(object):
+    # Durable record of the jobs of a sync run, one (review id, stage) job
+    # per entry. Every change is appended as one json line and flushed to
+    # disk, the file is compacted with an atomic replace whenever a step
+    # begins. A run that stopped half way is resumed by loading the journal
+    # and picking up the jobs that are not done, jobs that were running
+    # when the process died count as pending. A review with a job that
+    # failed max_attempts times is no longer pending.
+    def __init__(
+        self,
+        name: str,
+        conf=DEFAULT_CONF_PATH,
+        max_attempts: int = MAX_ATTEMPTS,
+    ):
+        self.name = name
+        self.max_attempts = max_attempts
+        self.path = os.path.join(
+            get_cache_location(conf), f"sync_journal_{name}.jsonl"
+        )
+        self.steps = {}
+        self.jobs = {}
+        self._lock = threading.Lock()
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def load(self) -> "SyncJournal":
+        self.steps, self.jobs = {}, {}
+        if not self.exists():
+            return self
+        with open(self.path) as journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a line cut short by a crash
+                    continue
+                self._apply(record)
+        return self
+
+    def _apply(self, record: dict):
+        step = record["step"]
+        if "review_ids" in record:
+            self.steps[step] = {
+                "review_ids": record["review_ids"],
+                "stages": record["stages"],
+            }
+            jobs = self.jobs.setdefault(step, {})
+            for review_id in record["review_ids"]:
+                for stage in record["stages"]:
+                    jobs.setdefault((review_id, stage), self._new_job())
+            return
+        job = self.jobs.setdefault(step, {}).setdefault(
+            (record["review_id"], record["stage"]), self._new_job()
+        )
+        for key in ("state", "attempts", "last_error", "updated"):
+            if key in record:
+                job[key] = record[key]
+
+    @staticmethod
+    def _new_job() -> dict:
+        return {
+            "state": PENDING,
+            "attempts": 0,
+            "last_error": None,
+            "updated": None,
+        }
+
+    def _append(self, record: dict):
+        with open(self.path, "a") as journal_file:
+            journal_file.write(json.dumps(record) + "\n")
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+
+    def _compact(self):
+        lines = []
+        for step, step_data in self.steps.items():
+            lines.append({"step": step, **step_data})
+            for (review_id, stage), job in self.jobs.get(step, {}).items():
+                if job["updated"] is None:
+                    continue
+                lines.append(
+                    {
+                        "step": step,
+                        "review_id": review_id,
+                        "stage": stage,
+                        **job,
+                    }
+                )
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as journal_file:
+            for line in lines:
+                journal_file.write(json.dumps(line) + "\n")
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        os.replace(tmp_path, self.path)
+
+    def has_step(self, step: str) -> bool:
+        return step in self.steps
+
+    def begin_step(
+        self, step: str, review_ids: Iterable[str], stages: Iterable[str]
+    ) -> list[str]:
+        # records the jobs of a step unless the journal already holds it,
+        # returns the reviews that still have jobs to do
+        with self._lock:
+            if step not in self.steps:
+                self._apply(
+                    {
+                        "step": step,
+                        "review_ids": list(review_ids),
+                        "stages": list(stages),
+                    }
+                )
+                self._compact()
+        return self.pending(step)
+
+    def get_review_ids(self, step: str) -> Optional[list[str]]:
+        if step not in self.steps:
+            return None
+        return self.steps[step]["review_ids"][:]
+
+    def _is_exhausted(self, job: dict) -> bool:
+        return job["state"] == FAILED and job["attempts"] >= self.max_attempts
+
+    def pending(self, step: str) -> list[str]:
+        if step not in self.steps:
+            return []
+        jobs = self.jobs.get(step, {})
+        pending = []
+        for review_id in self.steps[step]["review_ids"]:
+            review_jobs = [
+                jobs[(review_id, stage)]
+                for stage in self.steps[step]["stages"]
+            ]
+            if any(self._is_exhausted(job) for job in review_jobs):
+                continue
+            if any(job["state"] != DONE for job in review_jobs):
+                pending.append(review_id)
+        return pending
+
+    def exhausted(self) -> list[tuple[str, str, str, Optional[str]]]:
+        # (step, review id, stage, last error) of the jobs given up on
+        return [
+            (step, review_id, stage, job["last_error"])
+            for step, jobs in self.jobs.items()
+            for (review_id, stage), job in jobs.items()
+            if self._is_exhausted(job)
+        ]
+
+    def is_done(self, step: str, review_id: str, stage: str) -> bool:
+        job = self.jobs.get(step, {}).get((review_id, stage))
+        return job is not None and job["state"] == DONE
+
+    def _update(self, step: str, review_id: str, stage: str, **changes):
+        with self._lock:
+            record = {
+                "step": step,
+                "review_id": review_id,
+                "stage": stage,
+                "updated": time.time(),
+                **changes,
+            }
+            self._apply(record)
+            self._append(record)
+
+    def start(self, step: str, review_id: str, stage: str):
+        job = self.jobs.get(step, {}).get((review_id, stage))
+        attempts = job["attempts"] if job is not None else 0
+        self._update(
+            step, review_id, stage, state=RUNNING, attempts=attempts + 1
+        )
+
+    def done(self, step: str, review_id: str, stage: str):
+        self._update(step, review_id, stage, state=DONE, last_error=None)
+
+    def fail(self, step: str, review_id: str, stage: str, error: str):
+        self._update(step, review_id, stage, state=FAILED, last_error=error)
+
+    def fail_review(self, step: str, review_id: str, error: str):
+        # gives up on the unfinished stages of the review
+        if step not in self.steps:
+            return
+        for stage in self.steps[step]["stages"]:
+            if not self.is_done(step, review_id, stage):
+                self.fail(step, review_id, stage, error)
+
+    def is_complete(self) -> bool:
+        return not any(self.pending(step) for step in self.steps)
+
+    def finish(self):
+        # the run is complete, nothing is left to resume
+        with self._lock:
+            if self.exists():
+                os.remove(self.path)
+            self.steps, self.jobs = {}, {}
@@ -0,0 +1,296 @@
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Iterator, Optional
+import csv
+import json
+import os
+import sqlite3
+import time
+
+
+NOTES_FILENAME = "notes_index.sqlite3"
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS note_files (
+    review_id TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    num_notes INTEGER NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS notes (
+    review_id TEXT NOT NULL,
+    row INTEGER NOT NULL,
+    item_id TEXT,
+    item_name TEXT,
+    author TEXT,
+    frame INTEGER,
+    created REAL,
+    text TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (review_id, row)
+);
+CREATE INDEX IF NOT EXISTS notes_item_id ON notes (item_id);
+CREATE INDEX IF NOT EXISTS notes_item_name ON notes (item_name);
+CREATE INDEX IF NOT EXISTS notes_author ON notes (author);
+CREATE INDEX IF NOT EXISTS notes_created ON notes (created);
+"""
+
+TABLES = ("note_files", "notes")
+
+# csv headers accepted for each indexed column, compared case insensitively
+NOTE_COLUMNS = {
+    "item_name": ("item", "item name", "file", "file name", "media"),
+    "author": ("author", "user", "username", "created by", "by"),
+    "frame": ("frame", "frame number"),
+    "created": ("created", "created at", "date", "timestamp", "time"),
+    "text": ("note", "notes", "comment", "text", "message"),
+}
+
+CREATED_FORMATS = (
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%d %H:%M",
+    "%m/%d/%Y %H:%M:%S",
+    "%m/%d/%Y %H:%M",
+    "%m/%d/%Y",
+    "%b %d, %Y, %I:%M %p",
+)
+
+_stores = {}
+
+
+def get_notes_store(cache_base_dir: str) -> "NotesStore":
+    if cache_base_dir not in _stores:
+        _stores[cache_base_dir] = NotesStore(cache_base_dir)
+    return _stores[cache_base_dir]
+
+
+def parse_created(value: str) -> Optional[float]:
+    value = value.strip()
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        pass
+    for created_format in CREATED_FORMATS:
+        try:
+            return datetime.strptime(value, created_format).timestamp()
+        except ValueError:
+            continue
+    return None
+
+
+def parse_frame(value: str) -> Optional[int]:
+    try:
+        return int(float(value))
+    except ValueError:
+        return None
+
+
+def get_column_map(fieldnames: list[str]) -> dict[str, str]:
+    # indexed column -> csv header
+    headers = {name.strip().lower(): name for name in fieldnames}
+    columns = {}
+    for column, candidates in NOTE_COLUMNS.items():
+        for candidate in candidates:
+            if candidate in headers:
+                columns[column] = headers[candidate]
+                break
+    return columns
+
+
+def read_notes(csv_path: str) -> list[dict]:
+    with open(csv_path, newline="") as csv_file:
+        return list(csv.DictReader(csv_file, delimiter=","))
+
+
+class NotesStore(object):
+    # SQLite store of the notes exported in the review csv files. A csv is
+    # parsed again only when its size or mtime changes, queries across
+    # reviews never open the csv files.
+    def __init__(self, cache_base_dir: str):
+        self.cache_base_dir = cache_base_dir
+        self.path = os.path.join(cache_base_dir, NOTES_FILENAME)
+        self._initialized = False
+
+    @contextmanager
+    def connect(self) -> Iterator[sqlite3.Connection]:
+        if not os.path.exists(self.cache_base_dir):
+            os.makedirs(self.cache_base_dir)
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            if not self._initialized:
+                self._initialize(conn)
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _initialize(self, conn: sqlite3.Connection):
+        # rollback journal as for the cache index, WAL is unsafe on the
+        # network share the cache lives on
+        conn.execute("PRAGMA journal_mode=DELETE")
+        with conn:
+            conn.executescript(SCHEMA)
+            row = conn.execute(
+                "SELECT value FROM meta WHERE key = 'schema_version'"
+            ).fetchone()
+            if row is None or int(row[0]) != SCHEMA_VERSION:
+                for table in TABLES:
+                    conn.execute(f"DROP TABLE IF EXISTS {table}")
+                conn.execute("DELETE FROM meta")
+                conn.executescript(SCHEMA)
+                conn.execute(
+                    "INSERT INTO meta VALUES ('schema_version', ?)",
+                    (str(SCHEMA_VERSION),),
+                )
+        self._initialized = True
+
+    def is_current(self, review_id: str, csv_path: str) -> bool:
+        stat = os.stat(csv_path)
+        with self.connect() as conn:
+            row = conn.execute(
+                "SELECT path, size, mtime FROM note_files"
+                " WHERE review_id = ?",
+                (review_id,),
+            ).fetchone()
+        return row is not None and tuple(row) == (
+            csv_path,
+            stat.st_size,
+            stat.st_mtime,
+        )
+
+    def update(
+        self,
+        review_id: str,
+        csv_path: str,
+        review_items: Optional[list[dict]] = None,
+    ) -> bool:
+        # review_items resolve the item names of the csv to item ids,
+        # returns whether the csv was parsed
+        if self.is_current(review_id, csv_path):
+            return False
+        stat = os.stat(csv_path)
+        rows = read_notes(csv_path)
+        columns = get_column_map(list(rows[0])) if rows else {}
+        item_ids = {
+            item["name"]: item["id"]
+            for item in review_items or []
+            if item.get("name")
+        }
+        with self.connect() as conn:
+            conn.execute(
+                "DELETE FROM notes WHERE review_id = ?", (review_id,)
+            )
+            for idx, row in enumerate(rows):
+                values = {
+                    column: row.get(header) or ""
+                    for column, header in columns.items()
+                }
+                item_name = values.get("item_name") or None
+                conn.execute(
+                    "INSERT INTO notes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        review_id,
+                        idx,
+                        item_ids.get(item_name),
+                        item_name,
+                        values.get("author") or None,
+                        parse_frame(values.get("frame", "")),
+                        parse_created(values.get("created", "")),
+                        values.get("text"),
+                        json.dumps(row),
+                    ),
+                )
+            conn.execute(
+                "INSERT OR REPLACE INTO note_files VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    review_id,
+                    csv_path,
+                    stat.st_size,
+                    stat.st_mtime,
+                    len(rows),
+                    time.time(),
+                ),
+            )
+        return True
+
+    def remove(self, review_id: str):
+        with self.connect() as conn:
+            for table in TABLES:
+                conn.execute(
+                    f"DELETE FROM {table} WHERE review_id = ?", (review_id,)
+                )
+
+    def query(
+        self,
+        review_id: Optional[str] = None,
+        item_id: Optional[str] = None,
+        item_name: Optional[str] = None,
+        author: Optional[str] = None,
+        frame: Optional[int] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+    ) -> list[dict]:
+        conditions = []
+        params = []
+        for column, value in (
+            ("review_id", review_id),
+            ("item_id", item_id),
+            ("item_name", item_name),
+            ("author", author),
+            ("frame", frame),
+        ):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if since is not None:
+            conditions.append("created >= ?")
+            params.append(since.timestamp())
+        if until is not None:
+            conditions.append("created < ?")
+            params.append(until.timestamp())
+        where = " AND ".join(conditions) or "1"
+        with self.connect() as conn:
+            rows = conn.execute(
+                "SELECT review_id, row, item_id, item_name, author, frame,"
+                " created, text, data FROM notes"
+                f" WHERE {where} ORDER BY review_id, row",
+                params,
+            ).fetchall()
+        notes = []
+        for row in rows:
+            note = dict(row)
+            note["data"] = json.loads(note["data"])
+            if note["created"] is not None:
+                note["created"] = datetime.fromtimestamp(note["created"])
+            notes.append(note)
+        return notes
+
+    def get_review_notes(self, review_id: str) -> list[dict]:
+        return [note["data"] for note in self.query(review_id=review_id)]
+
+    def get_item_notes(self, item_id: str) -> list[dict]:
+        return self.query(item_id=item_id)
+
+    def get_notes_since(self, since: datetime) -> list[dict]:
+        return self.query(since=since)
+
+    def count_notes(self, review_id: Optional[str] = None) -> int:
+        with self.connect() as conn:
+            if review_id is None:
+                row = conn.execute("SELECT COUNT(*) FROM notes").fetchone()
+            else:
+                row = conn.execute(
+                    "SELECT COUNT(*) FROM notes WHERE review_id = ?",
+                    (review_id,),
+                ).fetchone()
+        return row[0]
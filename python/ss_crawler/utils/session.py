@@ -0,0 +1,64 @@
+from logging import getLogger
+import json
+import os
+import threading
+
+from selenium.common.exceptions import WebDriverException
+from selenium.webdriver.remote.webdriver import WebDriver
+
+from ss_crawler.conf import ENV_PREFIX
+
+
+logger = getLogger(__name__)
+
+
+# the cookies of the last authenticated session, kept next to the
+# credentials as they give the same access
+SESSION_PATH = os.path.abspath(
+    os.path.expanduser(
+        os.environ.get(f"{ENV_PREFIX}SESSION", "~/.ss_crawler/session.json")
+    )
+)
+
+_session_lock = threading.Lock()
+
+
+def save_cookies(driver: WebDriver, path=SESSION_PATH):
+    cookies = driver.get_cookies()
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with _session_lock:
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as session_file:
+            json.dump(cookies, session_file)
+        os.replace(tmp_path, path)
+
+
+def load_cookies(path=SESSION_PATH) -> list[dict]:
+    try:
+        with open(path) as session_file:
+            return json.load(session_file)
+    except (OSError, ValueError):
+        return []
+
+
+def restore_cookies(driver: WebDriver, path=SESSION_PATH) -> bool:
+    # Adds the saved cookies to the session, the driver must be on a page of
+    # the domain they belong to. Returns whether any cookie was added.
+    added = 0
+    for cookie in load_cookies(path):
+        if "expiry" in cookie:
+            cookie["expiry"] = int(cookie["expiry"])
+        try:
+            driver.add_cookie(cookie)
+            added += 1
+        except WebDriverException as exc:
+            logger.debug(f"Cookie {cookie.get('name')} not restored: {exc}")
+    return bool(added)
+
+
+def clear_cookies(path=SESSION_PATH):
+    if os.path.exists(path):
+        os.remove(path)
@@ -0,0 +1,169 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, Iterator, Optional
+from zipfile import ZipFile, ZipInfo
+import datetime
+import os
+import shutil
+import threading
+
+from ..exceptions import CacheException
+
+
+SKETCH_EXTENSIONS = (".jpg",)
+EXTRACT_BUFFER_SIZE = 1024 * 1024
+
+
+def is_sketch(file_info: ZipInfo) -> bool:
+    return (
+        not file_info.is_dir()
+        and os.path.splitext(file_info.filename)[1].lower()
+        in SKETCH_EXTENSIONS
+    )
+
+
+def member_mtime(file_info: ZipInfo) -> float:
+    return datetime.datetime(*file_info.date_time).timestamp()
+
+
+class SketchArchive(object):
+    # Read access to the sketches of a review zip. Listing and reading only
+    # touch the zip's central directory and the requested members, nothing
+    # is written to disk unless extract is called.
+    def __init__(self, zip_path: str):
+        self.zip_path = zip_path
+        self._infos: Optional[dict[str, ZipInfo]] = None
+
+    def _get_infos(self) -> dict[str, ZipInfo]:
+        if self._infos is None:
+            with ZipFile(self.zip_path) as _zip:
+                self._infos = {
+                    file_info.filename: file_info
+                    for file_info in _zip.infolist()
+                    if is_sketch(file_info)
+                }
+        return self._infos
+
+    def names(self) -> list[str]:
+        return list(self._get_infos())
+
+    def get_info(self, name: str) -> ZipInfo:
+        return self._get_infos()[name]
+
+    def map_to_items(self, review_items: list[dict]) -> dict[str, list[str]]:
+        # sketches are named after the media they were drawn on, each one
+        # goes to the item with the longest name stem found in its path
+        stems = sorted(
+            (
+                (os.path.splitext(item["name"])[0].lower(), item["id"])
+                for item in review_items
+                if item.get("name")
+            ),
+            key=lambda stem: len(stem[0]),
+            reverse=True,
+        )
+        mapping = {item["id"]: [] for item in review_items}
+        for name in self.names():
+            lowered = name.lower()
+            for stem, item_id in stems:
+                if stem and stem in lowered:
+                    mapping[item_id].append(name)
+                    break
+        return mapping
+
+    def open(self, name: str) -> IO[bytes]:
+        # the returned stream keeps the zip open until it is closed
+        self.get_info(name)
+        _zip = ZipFile(self.zip_path)
+        try:
+            stream = _zip.open(name)
+        except BaseException:
+            _zip.close()
+            raise
+        close = stream.close
+
+        def _close():
+            close()
+            _zip.close()
+
+        stream.close = _close
+        return stream
+
+    def read(self, name: str) -> bytes:
+        with ZipFile(self.zip_path) as _zip:
+            return _zip.read(self.get_info(name))
+
+    def iter_read(self) -> Iterator[tuple[str, bytes]]:
+        with ZipFile(self.zip_path) as _zip:
+            for name, file_info in self._get_infos().items():
+                yield name, _zip.read(file_info)
+
+    def extract_path(self, dest_dir: str, name: str) -> str:
+        # member names are kept relative to dest_dir
+        path = os.path.normpath(os.path.join(dest_dir, name))
+        if os.path.commonpath([dest_dir, path]) != os.path.normpath(dest_dir):
+            raise CacheException(
+                f"Sketch path {name} is outside of {dest_dir}"
+            )
+        return path
+
+    def is_extracted(self, dest_dir: str, name: str) -> bool:
+        file_info = self.get_info(name)
+        try:
+            stat = os.stat(self.extract_path(dest_dir, name))
+        except OSError:
+            return False
+        return stat.st_size == file_info.file_size and int(
+            stat.st_mtime
+        ) == int(member_mtime(file_info))
+
+    def extract(
+        self,
+        dest_dir: str,
+        names: Optional[list[str]] = None,
+        workers: int = 4,
+    ) -> list[str]:
+        # extracts the sketches that are missing or changed in dest_dir,
+        # each thread reads through its own handle on the zip
+        if names is None:
+            names = self.names()
+        paths = [self.extract_path(dest_dir, name) for name in names]
+        pending = [
+            name for name in names if not self.is_extracted(dest_dir, name)
+        ]
+        if not pending:
+            return paths
+        local = threading.local()
+        handles = []
+        lock = threading.Lock()
+
+        def _get_zip() -> ZipFile:
+            if not hasattr(local, "zip"):
+                local.zip = ZipFile(self.zip_path)
+                with lock:
+                    handles.append(local.zip)
+            return local.zip
+
+        def _extract(name: str):
+            file_info = self.get_info(name)
+            path = self.extract_path(dest_dir, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            part_path = f"{path}.part"
+            with _get_zip().open(file_info) as src, open(
+                part_path, "wb"
+            ) as dst:
+                shutil.copyfileobj(src, dst, EXTRACT_BUFFER_SIZE)
+            mtime = member_mtime(file_info)
+            os.utime(part_path, (mtime, mtime))
+            os.replace(part_path, path)
+
+        try:
+            if workers > 1 and len(pending) > 1:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    list(executor.map(_extract, pending))
+            else:
+                for name in pending:
+                    _extract(name)
+        finally:
+            for handle in handles:
+                handle.close()
+        return paths
@@ -0,0 +1,436 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from logging import getLogger
+from typing import Optional
+from urllib.parse import urlsplit
+import json
+import os
+import re
+import threading
+import time
+
+import urllib3
+
+from ..exceptions import DownloadException
+from .checksum import Checksum
+from .filesize import FileSize
+
+
+logger = getLogger(__name__)
+
+
+CHUNK_SIZE = 1024 * 1024
+RANGE_SIZE = 64 * CHUNK_SIZE
+
+
+def cookie_header(url: str, cookies: list[dict]) -> str:
+    # the browser cookies that would be sent with a request to url
+    parts = urlsplit(url)
+    host = parts.hostname or ""
+    path = parts.path or "/"
+    now = time.time()
+    pairs = []
+    for cookie in cookies:
+        domain = cookie.get("domain", host).lstrip(".")
+        if host != domain and not host.endswith(f".{domain}"):
+            continue
+        if not path.startswith(cookie.get("path", "/")):
+            continue
+        if cookie.get("secure") and parts.scheme != "https":
+            continue
+        if cookie.get("expiry") is not None and cookie["expiry"] < now:
+            continue
+        pairs.append(f"{cookie['name']}={cookie['value']}")
+    return "; ".join(pairs)
+
+
+def parse_content_range(value: Optional[str]) -> tuple[int, int, int]:
+    # "bytes start-end/size" to (start, end, size)
+    match = re.match(r"^bytes (\d+)-(\d+)/(\d+)$", (value or "").strip())
+    if match is None:
+        raise DownloadException(f"Invalid Content-Range: {value}")
+    start, end, size = (int(group) for group in match.groups())
+    return start, end, size
+
+
+def discard(response):
+    # the connection of a response whose body is left unread cannot be
+    # reused for another request
+    response.close()
+
+
+class RangeState(object):
+    # Byte ranges of a .part file that are complete with the digest of their
+    # bytes, saved as json next to it along with the size and validators of
+    # the file they belong to
+    def __init__(self, path: str):
+        self.path = path
+        self.data = {}
+        self._lock = threading.Lock()
+
+    def resume(self, validator: dict, part_path: str) -> bool:
+        try:
+            with open(self.path) as state_file:
+                data = json.load(state_file)
+        except (OSError, ValueError):
+            return False
+        if data.get("validator") != validator:
+            return False
+        if any(len(done) != 3 for done in data.get("done", [])):
+            # saved before the digests of the ranges were kept
+            return False
+        try:
+            if os.path.getsize(part_path) != validator["size"]:
+                return False
+        except OSError:
+            return False
+        self.data = data
+        return True
+
+    def reset(self, validator: dict, range_size: int):
+        self.data = {
+            "validator": validator,
+            "range_size": range_size,
+            "done": [],
+        }
+
+    def ranges(self) -> list[tuple[int, int]]:
+        size = self.data["validator"]["size"]
+        range_size = self.data["range_size"]
+        return [
+            (start, min(start + range_size, size) - 1)
+            for start in range(0, size, range_size)
+        ]
+
+    def pending(self) -> list[tuple[int, int]]:
+        done = {(start, end) for start, end, _ in self.data["done"]}
+        return [bounds for bounds in self.ranges() if bounds not in done]
+
+    def complete(self, start: int, end: int, digest: str):
+        with self._lock:
+            self.data["done"].append([start, end, digest])
+            self.save()
+
+    def digests(self) -> list[str]:
+        # of the ranges in order, once they are all complete
+        digests = {
+            (start, end): digest for start, end, digest in self.data["done"]
+        }
+        return [digests[bounds] for bounds in self.ranges()]
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as state_file:
+            json.dump(self.data, state_file)
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class PendingTransfer(object):
+    # A media file to fetch over http with the session of the browser it
+    # was found in, run() can be called from any thread
+    def __init__(
+        self,
+        transfer: "HttpTransfer",
+        url: str,
+        dest: str,
+        headers: dict[str, str],
+        file_size: Optional[FileSize] = None,
+    ):
+        self.transfer = transfer
+        self.url = url
+        self.dest = dest
+        self.headers = headers
+        self.file_size = file_size
+        # of the fetched file once run() returned
+        self.checksum = Checksum()
+
+    def run(self) -> str:
+        return self.transfer.fetch(
+            self.url, self.dest, self.headers, self.file_size, self.checksum
+        )
+
+    def close(self):
+        pass
+
+    def __repr__(self):
+        return f"PendingTransfer({self.url!r}, {self.dest!r})"
+
+
+class HttpTransfer(object):
+    # Fetches files over pooled keep-alive connections and streams them to
+    # their destination through a .part file, so that at most one chunk per
+    # connection is held in memory and the destination is only ever
+    # complete. Servers supporting ranges are fetched range_size ranges at
+    # a time, which an interrupted fetch resumes from.
+    def __init__(
+        self,
+        num_pools: int = 4,
+        maxsize: int = 4,
+        retries: int = 3,
+        connect_timeout: float = 10,
+        read_timeout: float = 60,
+        chunk_size: int = CHUNK_SIZE,
+        range_size: int = RANGE_SIZE,
+        range_workers: int = 4,
+    ):
+        # range_workers ranges of one file are fetched at a time, maxsize
+        # bounds the connections kept alive per host
+        self.chunk_size = chunk_size
+        self.range_size = range_size
+        self.range_workers = range_workers
+        self.pool = urllib3.PoolManager(
+            num_pools=num_pools,
+            maxsize=maxsize,
+            block=True,
+            retries=urllib3.Retry(
+                total=retries,
+                backoff_factor=1,
+                status_forcelist=(429, 500, 502, 503, 504),
+            ),
+            timeout=urllib3.Timeout(
+                connect=connect_timeout, read=read_timeout
+            ),
+        )
+
+    def prepare(
+        self,
+        driver,
+        url: str,
+        dest: str,
+        file_size: Optional[FileSize] = None,
+    ) -> PendingTransfer:
+        # reads the session from the driver, which must happen on the
+        # thread driving the browser
+        # an encoded body would not match the sizes and ranges of the file
+        headers = {
+            "User-Agent": driver.execute_script("return navigator.userAgent"),
+            "Accept-Encoding": "identity",
+        }
+        cookies = cookie_header(url, driver.get_cookies())
+        if cookies:
+            headers["Cookie"] = cookies
+        return PendingTransfer(self, url, dest, headers, file_size)
+
+    def _request(self, url: str, headers: dict[str, str]):
+        try:
+            return self.pool.request(
+                "GET", url, headers=headers, preload_content=False
+            )
+        except urllib3.exceptions.HTTPError as exc:
+            raise DownloadException(f"GET {url} failed: {exc}") from exc
+
+    def _write(
+        self, response, part_file, checksum: Optional[Checksum] = None
+    ) -> int:
+        written = 0
+        try:
+            for chunk in response.stream(self.chunk_size):
+                part_file.write(chunk)
+                written += len(chunk)
+                if checksum is not None:
+                    checksum.update(chunk)
+        except urllib3.exceptions.HTTPError as exc:
+            raise DownloadException(f"Transfer failed: {exc}") from exc
+        return written
+
+    def fetch(
+        self,
+        url: str,
+        dest: str,
+        headers: dict[str, str],
+        file_size: Optional[FileSize] = None,
+        checksum: Optional[Checksum] = None,
+    ) -> str:
+        # Fetches ranges of the file in parallel when the server supports
+        # them, the progress is kept in a sidecar of the .part file so that
+        # a later fetch of the same file continues where this one stopped.
+        # checksum is fed with the bytes of the fetched file.
+        directory = os.path.dirname(dest)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        response = self._request(url, {**headers, "Range": "bytes=0-0"})
+        if response.status == 416:
+            # an empty file has no range to serve
+            discard(response)
+            response.release_conn()
+            response = self._request(url, headers)
+        if response.status == 200:
+            # ranges are not supported and the whole file is on its way
+            return self._fetch_whole(
+                url, dest, response, file_size, checksum
+            )
+        try:
+            if response.status != 206:
+                raise DownloadException(
+                    f"GET {url} failed with status {response.status}"
+                )
+            validator = {
+                "size": parse_content_range(
+                    response.headers.get("Content-Range")
+                )[2],
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+            response.drain_conn()
+        except BaseException:
+            discard(response)
+            raise
+        finally:
+            response.release_conn()
+        return self._fetch_ranges(
+            url, dest, headers, validator, file_size, checksum
+        )
+
+    def _fetch_whole(
+        self,
+        url: str,
+        dest: str,
+        response,
+        file_size: Optional[FileSize] = None,
+        checksum: Optional[Checksum] = None,
+    ) -> str:
+        part_path = f"{dest}.part"
+        try:
+            with open(part_path, "wb") as part_file:
+                written = self._write(response, part_file, checksum)
+        except BaseException:
+            discard(response)
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+        finally:
+            response.release_conn()
+        # Content-Length counts the encoded bytes when the server encoded
+        # the body anyway, while written counts the decoded ones
+        length = response.headers.get("Content-Length")
+        encoding = response.headers.get("Content-Encoding", "identity")
+        if encoding.strip().lower() != "identity":
+            length = None
+        if (length is not None and int(length) != written) or (
+            file_size is not None and not file_size.matches(written)
+        ):
+            os.remove(part_path)
+            raise DownloadException(
+                f"GET {url} transferred {written} bytes, expected"
+                f" {length if length is not None else file_size}"
+            )
+        os.replace(part_path, dest)
+        return dest
+
+    def _fetch_ranges(
+        self,
+        url: str,
+        dest: str,
+        headers: dict[str, str],
+        validator: dict,
+        file_size: Optional[FileSize] = None,
+        checksum: Optional[Checksum] = None,
+    ) -> str:
+        size = validator["size"]
+        if file_size is not None and not file_size.matches(size):
+            raise DownloadException(
+                f"GET {url} serves {size} bytes, expected {file_size}"
+            )
+        part_path = f"{dest}.part"
+        state = RangeState(f"{part_path}.json")
+        if not state.resume(validator, part_path):
+            # nothing to continue from, or the file changed on the server
+            state.reset(validator, self.range_size)
+            with open(part_path, "wb") as part_file:
+                part_file.truncate(size)
+            state.save()
+        pending = state.pending()
+        if pending:
+            logger.debug(
+                f"Fetching {len(pending)} ranges of {url} into {part_path}"
+            )
+        errors = []
+        with ThreadPoolExecutor(max_workers=self.range_workers) as executor:
+            futures = {
+                executor.submit(
+                    self._fetch_range, url, headers, part_path, start, end
+                ): (start, end)
+                for start, end in pending
+            }
+            for future in as_completed(futures):
+                try:
+                    digest = future.result()
+                except DownloadException as exc:
+                    errors.append(exc)
+                    continue
+                state.complete(*futures[future], digest)
+        if errors:
+            # the .part file and its state are kept for the next fetch
+            raise DownloadException(
+                f"{len(errors)} of {len(pending)} ranges of {url} failed:"
+                f" {errors[0]}"
+            )
+        if os.path.getsize(part_path) != size:
+            state.remove()
+            os.remove(part_path)
+            raise DownloadException(f"{part_path} is not {size} bytes")
+        if checksum is not None:
+            # the ranges arrived out of order, possibly over several runs,
+            # each was hashed as it was written
+            checksum.record_blocks(
+                state.data["range_size"], size, state.digests()
+            )
+        os.replace(part_path, dest)
+        state.remove()
+        return dest
+
+    def _fetch_range(
+        self,
+        url: str,
+        headers: dict[str, str],
+        part_path: str,
+        start: int,
+        end: int,
+    ) -> str:
+        # returns the digest of the range
+        range_checksum = Checksum()
+        response = self._request(
+            url, {**headers, "Range": f"bytes={start}-{end}"}
+        )
+        try:
+            if response.status != 206:
+                raise DownloadException(
+                    f"GET {url} bytes {start}-{end} failed with status"
+                    f" {response.status}"
+                )
+            served = parse_content_range(
+                response.headers.get("Content-Range")
+            )
+            if served[:2] != (start, end):
+                raise DownloadException(
+                    f"GET {url} served bytes {served[0]}-{served[1]}"
+                    f" for {start}-{end}"
+                )
+            with open(part_path, "r+b") as part_file:
+                part_file.seek(start)
+                written = self._write(response, part_file, range_checksum)
+        except BaseException:
+            discard(response)
+            raise
+        finally:
+            response.release_conn()
+        if written != end - start + 1:
+            raise DownloadException(
+                f"GET {url} bytes {start}-{end} transferred {written} bytes"
+            )
+        return range_checksum.digest
+
+
+_transfer = None
+_transfer_lock = threading.Lock()
+
+
+def get_http_transfer() -> HttpTransfer:
+    global _transfer
+    with _transfer_lock:
+        if _transfer is None:
+            _transfer = HttpTransfer()
+    return _transfer
@@ -1,41 +1,158 @@
+from typing import Optional
+from weakref import WeakKeyDictionary, WeakSet
+import os
+
 from selenium import webdriver
+from selenium.common.exceptions import WebDriverException
+from selenium.webdriver.remote.command import Command
 from selenium.webdriver.remote.webdriver import WebDriver
 
 from ..conf import (
+    get_crawl_mode,
     get_download_location,
+    get_user_data_dir,
     chrome_driver_location,
     DEFAULT_CONF_PATH,
 )
 from . import download_management
 
 
-def get_chrome_driver(conf=DEFAULT_CONF_PATH) -> WebDriver:
+# The crawl mode runs chrome headless with a fixed viewport, the geometry
+# SubPage.move_mouse_to and scroll_to_top rely on is the same on every run
+CRAWL_WINDOW_SIZE = (1920, 1080)
+# Images are blocked through the content settings, which leave downloads
+# alone, media through the autoplay policy and fonts by url. Image and media
+# urls cannot be blocked as they are the urls review items download from.
+CRAWL_CONTENT_SETTINGS = {
+    "profile.managed_default_content_settings.images": 2,
+}
+CRAWL_ARGUMENTS = [
+    "--headless=new",
+    "--window-size={},{}".format(*CRAWL_WINDOW_SIZE),
+    "--autoplay-policy=user-gesture-required",
+    "--mute-audio",
+]
+CRAWL_BLOCKED_URLS = [
+    pattern
+    for ext in ("woff", "woff2", "ttf", "otf", "eot")
+    for pattern in (f"*.{ext}", f"*.{ext}?*")
+]
+
+
+_download_locations: "WeakKeyDictionary[WebDriver, str]" = (
+    WeakKeyDictionary()
+)
+
+
+# capabilities each driver was created with, to start a new session with
+_capabilities: "WeakKeyDictionary[WebDriver, dict]" = WeakKeyDictionary()
+_crawl_mode_drivers: "WeakSet[WebDriver]" = WeakSet()
+
+
+def get_driver_download_location(driver: WebDriver) -> Optional[str]:
+    return _download_locations.get(driver)
+
+
+def is_crawl_mode(driver: WebDriver) -> bool:
+    return driver in _crawl_mode_drivers
+
+
+def setup_crawl_mode(driver: WebDriver, download_location: str):
+    # The blocked urls and the download behaviour are set on the session
+    # through the devtools protocol, so they are set again on restarts
+    driver.execute_cdp_cmd("Network.enable", {})
+    driver.execute_cdp_cmd(
+        "Network.setBlockedURLs", {"urls": CRAWL_BLOCKED_URLS}
+    )
+    driver.execute_cdp_cmd(
+        "Page.setDownloadBehavior",
+        {"behavior": "allow", "downloadPath": download_location},
+    )
+
+
+def restart_session(driver: WebDriver, maximize: bool = True):
+    # Replaces the browser session of driver in place, so that everything
+    # holding on to the driver keeps working. The chromedriver service is
+    # kept, only the browser is started again.
+    try:
+        driver.execute(Command.QUIT)
+    except WebDriverException:
+        # the session is usually dead already
+        pass
+    driver.start_session(_capabilities[driver])
+    if is_crawl_mode(driver):
+        setup_crawl_mode(driver, _download_locations[driver])
+    elif maximize:
+        driver.maximize_window()
+
+
+def get_chrome_driver(
+    conf=DEFAULT_CONF_PATH,
+    download_location: Optional[str] = None,
+    crawl_mode: Optional[bool] = None,
+    profile: str = "default",
+) -> WebDriver:
+    # crawl_mode defaults to the crawl_mode of the config. With a
+    # user_data_dir in the config the browser keeps its profile, and with it
+    # the login, under user_data_dir/profile. Chrome locks a profile, drivers
+    # running at the same time need different profiles.
+    if download_location is None:
+        download_location = get_download_location(conf)
+    if crawl_mode is None:
+        crawl_mode = get_crawl_mode(conf)
     chrome_options = webdriver.ChromeOptions()
     prefs = {}
-    prefs["download.default_directory"] = get_download_location(conf)
+    prefs["download.default_directory"] = download_location
+    if crawl_mode:
+        prefs["download.prompt_for_download"] = False
+        prefs.update(CRAWL_CONTENT_SETTINGS)
+        for argument in CRAWL_ARGUMENTS:
+            chrome_options.add_argument(argument)
+    user_data_dir = get_user_data_dir(conf)
+    if user_data_dir is not None:
+        chrome_options.add_argument(
+            f"--user-data-dir={os.path.join(user_data_dir, profile)}"
+        )
     chrome_options.add_experimental_option("prefs", prefs)
     driver = webdriver.Chrome(
         executable_path=chrome_driver_location(conf),
         chrome_options=chrome_options,
     )
+    _download_locations[driver] = download_location
+    _capabilities[driver] = chrome_options.to_capabilities()
+    if crawl_mode:
+        _crawl_mode_drivers.add(driver)
+        setup_crawl_mode(driver, download_location)
     return driver
 
 
 class ChromeDriver(object):
     def __init__(
-        self, conf=DEFAULT_CONF_PATH, clear_downloads_dir=True, maximize=True
+        self,
+        conf=DEFAULT_CONF_PATH,
+        clear_downloads_dir=True,
+        maximize=True,
+        download_location: Optional[str] = None,
+        crawl_mode: Optional[bool] = None,
+        profile: str = "default",
     ):
         self.clear_downloads_dir = clear_downloads_dir
         self.maximize = maximize
         self.conf = conf
+        if download_location is None:
+            download_location = get_download_location(conf)
+        self.download_location = download_location
+        self.crawl_mode = crawl_mode
+        self.profile = profile
 
     def __enter__(self) -> WebDriver:
         if self.clear_downloads_dir:
-            download_management.remove_dir_contents(
-                get_download_location(self.conf)
-            )
-        self.driver = get_chrome_driver(self.conf)
-        if self.maximize:
+            download_management.remove_dir_contents(self.download_location)
+        self.driver = get_chrome_driver(
+            self.conf, self.download_location, self.crawl_mode, self.profile
+        )
+        # the crawl mode has a fixed window size
+        if self.maximize and not is_crawl_mode(self.driver):
             self.driver.maximize_window()
         return self.driver
 
@@ -0,0 +1,160 @@
+from queue import Empty, Queue
+from typing import Callable, Iterable, Optional
+from weakref import WeakKeyDictionary
+import collections
+import os
+import threading
+import time
+import traceback
+
+from selenium.common.exceptions import WebDriverException
+from selenium.webdriver.remote.webdriver import WebDriver
+
+from ss_crawler.conf import DEFAULT_CONF_PATH, get_download_location
+from ss_crawler.exceptions import SSCrawlerException
+from ss_crawler.health import HealthMonitor
+from ss_crawler.recovery import RecoveryPolicy
+from ss_crawler.scripts import ensure_project_page, restart_browser
+from ss_crawler.utils.download_management import DownloadPipeline
+from ss_crawler.utils.webdriver import ChromeDriver
+
+
+class SyncWorkerPool(object):
+    # Runs jobs over several ChromeDriver sessions. Every worker downloads
+    # into its own directory so that DownloadManager can attribute its
+    # downloads, and pulls work from one shared queue. Failed jobs go back
+    # into the queue until they have been tried max_tries times in total,
+    # on whichever worker picks them up. A worker's browser is only
+    # restarted once its downloads handed to pipeline are complete.
+    def __init__(
+        self,
+        num_workers: int,
+        conf=DEFAULT_CONF_PATH,
+        max_tries: int = 3,
+        monitor: Optional[HealthMonitor] = None,
+        pipeline: Optional[DownloadPipeline] = None,
+    ):
+        self.num_workers = num_workers
+        self.conf = conf
+        self.max_tries = max_tries
+        if monitor is None:
+            monitor = HealthMonitor(conf)
+        self.monitor = monitor
+        self.pipeline = pipeline
+        self.tries = collections.defaultdict(int)
+        self.failed = []
+        self.recovery = RecoveryPolicy(before_restart=self._drain)
+        self._download_locations: "WeakKeyDictionary[WebDriver, str]" = (
+            WeakKeyDictionary()
+        )
+        self._lock = threading.Lock()
+
+    def worker_download_location(self, index: int) -> str:
+        return os.path.join(
+            get_download_location(self.conf), f"worker_{index}"
+        )
+
+    def run(
+        self, items: Iterable[str], job: Callable[[WebDriver, str], None]
+    ) -> list[str]:
+        queue = Queue()
+        for item in items:
+            queue.put(item)
+        print(
+            f"Syncing {queue.qsize()} items with {self.num_workers} workers"
+        )
+        workers = [
+            threading.Thread(
+                target=self._work,
+                args=(index, queue, job),
+                name=f"sync_worker_{index}",
+                daemon=True,
+            )
+            for index in range(self.num_workers)
+        ]
+        for worker in workers:
+            worker.start()
+        while queue.unfinished_tasks:
+            if not any(worker.is_alive() for worker in workers):
+                print("All workers stopped with work left in the queue!")
+                break
+            time.sleep(1)
+        for _ in workers:
+            queue.put(None)
+        for worker in workers:
+            worker.join()
+        while True:
+            try:
+                item = queue.get_nowait()
+            except Empty:
+                break
+            if item is not None:
+                self.failed.append(item)
+        report = self.recovery.report()
+        if report:
+            print(f"Recoveries:\n{report}")
+        return self.failed[:]
+
+    def _retry(self, queue: Queue, item: str) -> int:
+        # returns the number of times item failed
+        with self._lock:
+            self.tries[item] += 1
+            tries = self.tries[item]
+            if tries >= self.max_tries:
+                self.failed.append(item)
+        if tries < self.max_tries:
+            queue.put(item)
+        return tries
+
+    def _drain(self, driver: WebDriver):
+        if self.pipeline is not None:
+            self.pipeline.drain(self._download_locations.get(driver))
+
+    def _maintain(self, driver: WebDriver):
+        def _restart():
+            self._drain(driver)
+            restart_browser(driver)
+            self.recovery.register(driver)
+
+        def _refresh():
+            ensure_project_page(driver).refresh()
+
+        self.monitor.maintain(driver, _refresh, _restart)
+
+    def _work(
+        self, index: int, queue: Queue, job: Callable[[WebDriver, str], None]
+    ):
+        with ChromeDriver(
+            self.conf,
+            download_location=self.worker_download_location(index),
+            profile=f"worker_{index}",
+        ) as driver:
+            self._download_locations[driver] = (
+                self.worker_download_location(index)
+            )
+            self.recovery.register(driver)
+            processed = 0
+            while True:
+                item = queue.get()
+                if item is None:
+                    queue.task_done()
+                    break
+                try:
+                    if processed:
+                        self._maintain(driver)
+                    processed += 1
+                    print(f"[worker_{index}] Syncing {item} ...")
+                    job(driver, item)
+                except (SSCrawlerException, WebDriverException) as exc:
+                    print(f"[worker_{index}] {item} errored with", exc)
+                    traceback.print_exc()
+                    tries = self._retry(queue, item)
+                    try:
+                        self.recovery.recover(driver, exc, tries)
+                    except (SSCrawlerException, WebDriverException):
+                        traceback.print_exc()
+                except BaseException:
+                    self._retry(queue, item)
+                    raise
+                finally:
+                    queue.task_done()
@@ -114,5 +114,36 @@ def test_get_review():
                 print("\t", ri.get_data())
 
 
+def benchmark_crawl_mode(num_reviews: int = 10):
+    # compares page load, full scroll and per review times of the default
+    # and the crawl mode browser over the same reviews
+    project_cache = ProjectCache(get_project_id())
+    project_cache.load_data()
+    review_ids = [r["id"] for r in project_cache.reviews[:num_reviews]]
+    results = {}
+    for crawl_mode in (False, True):
+        with ChromeDriver(crawl_mode=crawl_mode) as driver:
+            start = time.perf_counter()
+            project_page = load_project_page(driver)
+            page_load = time.perf_counter() - start
+            start = time.perf_counter()
+            project_page.scroll_to_end()
+            scroll = time.perf_counter() - start
+            review_times = []
+            for rid in review_ids:
+                start = time.perf_counter()
+                review = project_page.get_review(rid)
+                review.get_review_items_data()
+                review_times.append(time.perf_counter() - start)
+        results[crawl_mode] = (page_load, scroll, review_times)
+    for crawl_mode, (page_load, scroll, review_times) in results.items():
+        print(
+            f"crawl_mode={crawl_mode}: page load {page_load:.1f}s,"
+            f" scroll to end {scroll:.1f}s,"
+            f" per review {sum(review_times) / len(review_times):.2f}s"
+            f" (max {max(review_times):.2f}s)"
+        )
+
+
 if __name__ == "__main__":
     test_sync_from_cache()